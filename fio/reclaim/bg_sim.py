@@ -0,0 +1,415 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from thresh_sim import calc_threshes, replay, run_thresh, SERIES, TARGET_FRAC, TARGET_MIN, TARGET_MAX
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+# The series frag.sh collects, as in graph.py.
+STATS = [
+    "unalloc_bytes",
+    "unused_bytes",
+    "used_bytes",
+    "alloc_bytes",
+    "reclaims",
+    "reclaim_bytes",
+    "thresh",
+    "alloc_pct",
+    "used_pct",
+    "unused_unalloc_ratio"
+]
+
+# frag.sh defaults
+NRFILES = 100
+INTERLEAVE = 1 << 20
+NOISE = 100 << 20
+LOOPS = 100
+
+def parse_size(s):
+    mult = SIZE_SUFFIXES.get(s[-1:].upper())
+    if mult is None:
+        return int(s)
+    return int(float(s[:-1]) * mult)
+
+# A reclaim configuration as frag.sh names them: free-N and per-N set
+# bg_reclaim_threshold to N, free-dyn and per-dyn turn on dynamic_reclaim,
+# per-* turn on periodic_reclaim. target is the unallocated space the
+# dynamic threshold aims for, as thresh_sim's (fraction, min, max) in
+# block groups.
+class Policy:
+    def __init__(self, name, target=(TARGET_FRAC, TARGET_MIN, TARGET_MAX)):
+        kind, thresh = name.split('-')
+        if kind not in ('free', 'per'):
+            raise ValueError(f"unknown reclaim policy {name}")
+        self.name = name
+        self.periodic = kind == 'per'
+        self.dynamic = thresh == 'dyn'
+        self.thresh = 0 if self.dynamic else int(thresh)
+        self.target = target
+
+# The data space of a disk as block groups of bg_size, each tracked only by
+# its used bytes: the free space inside a block group counts as usable
+# whatever its shape. Files are written round robin in interleave sized
+# chunks, as fio does with nrfiles, and placed as pieces (file, block group,
+# len), filling the block groups with free space first-fit in the order
+# they were created, as the data allocator walks them. New block groups are
+# created from unallocated space when those are full. Everything a write,
+# rm or relocation touches is done as array operations over all its chunks.
+#
+# Reclaim follows the kernel:
+# - without periodic reclaim, a free that takes a block group from at or
+#   above the threshold to below it marks it, and the reclaim worker
+#   relocates the marked ones still below it;
+# - with periodic reclaim, once a block group worth of bytes more has been
+#   freed than allocated since the last sweep, the next one relocates the block groups below
+#   the threshold that no allocation went to since the sweep before, or
+#   any of them if there is no unallocated space left;
+# - the threshold is bg_reclaim_threshold, or the thresh_sim dynamic one;
+# - empty block groups are deleted without counting as reclaims.
+class BlockGroups:
+    def __init__(self, size, bg_size, interleave, policy, rng):
+        self.size = size
+        self.bg_size = bg_size
+        self.interleave = interleave
+        self.policy = policy
+        self.rng = rng
+        nr_slots = size // bg_size
+        self.used = np.zeros(nr_slots, dtype=np.int64)
+        self.alive = np.zeros(nr_slots, dtype=bool)
+        self.ro = np.zeros(nr_slots, dtype=bool)
+        self.mark = np.zeros(nr_slots, dtype=bool)
+        self.born = np.zeros(nr_slots, dtype=np.int64)
+        self.nr_born = 0
+        self.piece_file = np.zeros(0, dtype=np.int64)
+        self.piece_bg = np.zeros(0, dtype=np.int64)
+        self.piece_len = np.zeros(0, dtype=np.int64)
+        self.nr_pieces = 0
+        self.file_alive = np.zeros(0, dtype=bool)
+        self.file_group = np.zeros(0, dtype=np.int64)
+        self.nr_files = 0
+        self.nr_groups = 0
+        self.reclaimable = 0
+        self.sweep_ready = False
+        self.reclaims = 0
+        self.reclaim_bytes = 0
+        self.enospc = 0
+        self.ops = 0
+        self.series = {stat: [] for stat in STATS}
+
+    def alloc_bytes(self):
+        return int(self.alive.sum()) * self.bg_size
+
+    def used_bytes(self):
+        return int(self.used.sum())
+
+    def thresh_pct(self):
+        if not self.policy.dynamic:
+            return self.policy.thresh
+        units = np.array([self.size, self.alloc_bytes(), self.used_bytes()]) / self.bg_size
+        return int(100 * calc_threshes(*units, target=self.policy.target))
+
+    def thresh_bytes(self):
+        return self.bg_size * self.thresh_pct() // 100
+
+    def fill_order(self):
+        slots = np.flatnonzero(self.alive & ~self.ro)
+        return slots[np.argsort(self.born[slots])]
+
+    def new_bgs(self, n):
+        slots = np.flatnonzero(~self.alive)[:n]
+        self.alive[slots] = True
+        self.used[slots] = 0
+        self.mark[slots] = False
+        self.born[slots] = self.nr_born + np.arange(len(slots))
+        self.nr_born += len(slots)
+        return slots
+
+    def add_pieces(self, files, bgs, lens):
+        n = self.nr_pieces + len(files)
+        if n > len(self.piece_file):
+            cap = max(n, 2 * len(self.piece_file), 1024)
+            for name in ['piece_file', 'piece_bg', 'piece_len']:
+                old = getattr(self, name)
+                new = np.zeros(cap, dtype=np.int64)
+                new[:self.nr_pieces] = old[:self.nr_pieces]
+                setattr(self, name, new)
+        self.piece_file[self.nr_pieces:n] = files
+        self.piece_bg[self.nr_pieces:n] = bgs
+        self.piece_len[self.nr_pieces:n] = lens
+        self.nr_pieces = n
+
+    # Drop the pieces of removed files once they are most of the table.
+    def compact(self):
+        live = np.flatnonzero(self.piece_len[:self.nr_pieces] > 0)
+        if 2 * len(live) > self.nr_pieces:
+            return
+        for name in ['piece_file', 'piece_bg', 'piece_len']:
+            col = getattr(self, name)
+            col[:len(live)] = col[live]
+        self.nr_pieces = len(live)
+
+    # Place chunks of lens bytes of files, whole chunks in order until one
+    # does not fit, and return how many fit. A chunk may be split over block
+    # groups. Chunk i ends at ends[i] of the write and the free space of
+    # block group order[j] at bounds[j], so the pieces are the intervals
+    # between the merged ends and bounds.
+    def alloc(self, files, lens):
+        order = self.fill_order()
+        free = self.bg_size - self.used[order]
+        nr_unalloc = int((~self.alive).sum())
+        ends = np.cumsum(lens)
+        n = int(np.searchsorted(ends, int(free.sum()) + nr_unalloc * self.bg_size, side='right'))
+        if n == 0:
+            return 0
+        files, ends = files[:n], ends[:n]
+        total = int(ends[-1])
+        short = total - int(free.sum())
+        if short > 0:
+            new = self.new_bgs(-(-short // self.bg_size))
+            order = np.concatenate((order, new))
+            free = np.concatenate((free, np.full(len(new), self.bg_size)))
+        bounds = np.cumsum(free)
+        points = np.union1d(ends, bounds[bounds < total])
+        starts = np.concatenate(([0], points[:-1]))
+        piece_files = files[np.searchsorted(ends, starts, side='right')]
+        piece_bgs = order[np.searchsorted(bounds, starts, side='right')]
+        piece_lens = points - starts
+        self.add_pieces(piece_files, piece_bgs, piece_lens)
+        self.used += np.bincount(piece_bgs, weights=piece_lens, minlength=len(self.used)).astype(np.int64)
+        self.mark[piece_bgs] = False
+        self.reclaimable -= total
+        self.ops += n
+        return n
+
+    # fio --size=size --nrfiles=nrfiles: nrfiles files of size / nrfiles,
+    # written round robin until the disk is full. Returns the group id of
+    # the files that got any of it.
+    def write(self, size, nrfiles):
+        group = self.nr_groups
+        self.nr_groups += 1
+        per = max(size // nrfiles, 1)
+        rows = -(-per // self.interleave)
+        lens = np.full((rows, nrfiles), min(self.interleave, per), dtype=np.int64)
+        lens[-1] = per - (rows - 1) * self.interleave
+        files = np.tile(self.nr_files + np.arange(nrfiles), rows)
+        placed = self.alloc(files, lens.ravel())
+        if placed < files.size:
+            self.enospc += 1
+        n = min(placed, nrfiles)
+        self.file_alive = np.concatenate((self.file_alive, np.ones(n, dtype=bool)))
+        self.file_group = np.concatenate((self.file_group, np.full(n, group)))
+        self.nr_files += n
+        return group
+
+    def files(self, group=None):
+        alive = self.file_alive.copy()
+        if group is not None:
+            alive &= self.file_group == group
+        return np.flatnonzero(alive)
+
+    # rm of count random files, of one write or of all of them.
+    def rm(self, count, group=None):
+        cand = self.files(group)
+        gone = self.rng.choice(cand, min(count, len(cand)), replace=False)
+        self.file_alive[gone] = False
+        n = self.nr_pieces
+        dead = ~self.file_alive[self.piece_file[:n]] & (self.piece_len[:n] > 0)
+        freed = np.bincount(self.piece_bg[:n][dead], weights=self.piece_len[:n][dead],
+                            minlength=len(self.used)).astype(np.int64)
+        self.piece_len[:n][dead] = 0
+        old = self.used.copy()
+        self.used -= freed
+        self.reclaimable += int(freed.sum())
+        if self.reclaimable >= self.bg_size:
+            self.sweep_ready = True
+        self.ops += int(dead.sum())
+        thresh = self.thresh_bytes()
+        if not self.policy.periodic and thresh > 0:
+            self.mark |= (old >= thresh) & (self.used < thresh)
+        self.compact()
+
+    # Move the data of a block group elsewhere and delete it, unless what
+    # it holds does not fit in the rest of the space.
+    def relocate(self, bg):
+        n = self.nr_pieces
+        moved = np.flatnonzero((self.piece_bg[:n] == bg) & (self.piece_len[:n] > 0))
+        lens = self.piece_len[moved].copy()
+        files = self.piece_file[moved].copy()
+        nr_unalloc = int((~self.alive).sum())
+        room = int((self.bg_size - self.used[self.alive]).sum()) - (self.bg_size - int(self.used[bg]))
+        if int(lens.sum()) > room + nr_unalloc * self.bg_size:
+            return False
+        self.ro[bg] = True
+        self.piece_len[moved] = 0
+        self.alloc(files, lens)
+        self.used[bg] = 0
+        self.alive[bg] = False
+        self.ro[bg] = False
+        self.mark[bg] = False
+        self.reclaims += 1
+        self.reclaim_bytes += int(lens.sum())
+        return True
+
+    def reclaim(self):
+        self.alive &= self.used > 0
+        thresh = self.thresh_bytes()
+        if thresh == 0:
+            self.mark[:] = False
+            return
+        if self.policy.periodic:
+            if not self.sweep_ready:
+                return
+            self.sweep_ready = False
+            self.reclaimable = 0
+            under = self.alive & (self.used < thresh)
+            cand = under & self.mark
+            self.mark |= self.alive
+            if not cand.any() and self.alive.all():
+                cand = under
+        else:
+            cand = self.mark & self.alive
+            self.mark[:] = False
+        slots = np.flatnonzero(cand)
+        for bg in slots[np.argsort(self.born[slots])]:
+            if self.alive[bg] and self.used[bg] < thresh:
+                self.relocate(bg)
+        self.compact()
+
+    def sample(self):
+        alloc = self.alloc_bytes()
+        used = self.used_bytes()
+        unalloc = self.size - alloc
+        unused = alloc - used
+        vals = {
+            "unalloc_bytes": unalloc,
+            "unused_bytes": unused,
+            "used_bytes": used,
+            "alloc_bytes": alloc,
+            "reclaims": self.reclaims,
+            "reclaim_bytes": self.reclaim_bytes,
+            "thresh": self.thresh_pct(),
+            "alloc_pct": 100 * alloc // self.size,
+            "used_pct": 100 * used // alloc if alloc else 0,
+            "unused_unalloc_ratio": 100 * unused // unalloc if unalloc else 0,
+        }
+        for stat, val in vals.items():
+            self.series[stat].append(val)
+
+    # What the collect loop sees after each step of a workload: the reclaim
+    # worker has caught up with it.
+    def step(self):
+        self.reclaim()
+        self.sample()
+
+# The workloads of frag.sh, one step per fio or rm.
+def strict_frag(sim, level_pct, nrfiles):
+    pct_rm = 100 - level_pct
+    group = sim.write(sim.size, nrfiles)
+    sim.step()
+    count = len(sim.files(group))
+    sim.rm(count * pct_rm // 100, group)
+    sim.step()
+
+def bounce(sim, level_pct, bounce_pct, iters, nrfiles):
+    strict_frag(sim, level_pct - 5, nrfiles)
+    fsize = sim.size // 100
+    scale = nrfiles // NRFILES
+    for i in range(iters):
+        sim.write(fsize * bounce_pct, bounce_pct * scale)
+        sim.step()
+        sim.rm(bounce_pct * scale)
+        sim.step()
+
+def last_gig(sim, nrfiles):
+    total = 2 * sim.size
+    per = total // LOOPS
+    noise = sim.rng.integers(0, NOISE + 1, LOOPS) - NOISE // 2
+    for sz in np.sort(per + noise):
+        sim.write(int(sz), nrfiles)
+        sim.step()
+        sim.rm(nrfiles // 2)
+        sim.step()
+    # trigger_cleaner; wait_reclaim_done
+    sim.step()
+    sim.rm(nrfiles)
+    sim.step()
+
+WORKLOADS = {
+    'bounce': (bounce, [50, 10, 20]),
+    'strict_frag': (strict_frag, [50]),
+    'last_gig': (last_gig, []),
+}
+
+def run_workload(args, run):
+    policy = Policy(run, (args.target_frac, args.target_min, args.target_max))
+    sim = BlockGroups(args.size, args.bg_size, args.interleave, policy, np.random.default_rng(args.seed))
+    func, defaults = WORKLOADS[args.workload]
+    wargs = args.args + defaults[len(args.args):]
+    func(sim, *wargs, args.nrfiles)
+    # trigger_cleaner; wait_reclaim_done
+    sim.step()
+    sim.step()
+    return sim
+
+# The model's reclaims when thresh_sim --calibrate replays a run, which
+# should come close to the ones the run did.
+def model_reclaims(sim, run):
+    series = {stat: np.array(sim.series[stat], dtype=np.int64) for stat in SERIES[:3]}
+    return int(replay(series, run_thresh(run), sim.bg_size)['reclaims'][-1])
+
+def write_series(sim, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    for stat, vals in sim.series.items():
+        np.savetxt(f"{out_dir}/{stat}.dat", np.array(vals, dtype=np.int64), fmt='%d')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the frag.sh reclaim workloads per block group.",
+                                     epilog="workloads: bounce [level (%%) bounce (%%) iters], "
+                                            "strict_frag [level (%%)], last_gig")
+    parser.add_argument('--size', type=parse_size, default=100 << 30,
+                        help='Disk size (K/M/G/T suffixes allowed)')
+    parser.add_argument('--bg-size', type=parse_size, default=1 << 30,
+                        help='Block group size')
+    parser.add_argument('--nrfiles', type=int, default=NRFILES,
+                        help='Files per fio run, more files make smaller ones')
+    parser.add_argument('--interleave', type=parse_size, default=INTERLEAVE,
+                        help='Size of the round robin chunks of the files of one fio run')
+    parser.add_argument('--runs', default='free-30,per-30,per-dyn',
+                        help='Comma separated reclaim configurations: free-N, per-N, free-dyn, per-dyn')
+    parser.add_argument('--target-frac', type=float, default=TARGET_FRAC,
+                        help='Unallocated space the dynamic threshold aims for, as a fraction of the disk')
+    parser.add_argument('--target-min', type=float, default=TARGET_MIN,
+                        help='Lower clamp of that target, in block groups')
+    parser.add_argument('--target-max', type=float, default=TARGET_MAX,
+                        help='Upper clamp of that target, in block groups')
+    parser.add_argument('--results', default='results',
+                        help='Write the series to RESULTS/<workload>/sim-<run>/<stat>.dat')
+    parser.add_argument('--check-calib', type=int, metavar='N',
+                        help='Fail if the reclaims thresh_sim.py --calibrate replays from a run are more '
+                             'than N off the ones it did')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('workload', choices=WORKLOADS)
+    parser.add_argument('args', nargs='*', type=int)
+    args = parser.parse_args()
+    if args.nrfiles < NRFILES or args.nrfiles % NRFILES:
+        parser.error(f"--nrfiles must be a multiple of {NRFILES}")
+
+    bad = 0
+    for run in args.runs.split(','):
+        t = time.perf_counter()
+        sim = run_workload(args, run)
+        elapsed = time.perf_counter() - t
+        write_series(sim, f"{args.results}/{args.workload}/sim-{run}")
+        print(f"{args.workload} {run} reclaims {sim.reclaims} reclaim_bytes {sim.reclaim_bytes} "
+              f"enospc {sim.enospc} ops {sim.ops} {elapsed:.2f}s {int(sim.ops / elapsed)} ops/s")
+        if args.check_calib is not None:
+            model = model_reclaims(sim, run)
+            off = abs(model - sim.reclaims)
+            print(f"calib {args.workload} {run} reclaims {sim.reclaims} model {model} off {off}")
+            bad += off > args.check_calib
+    exit(1 if bad else 0)
@@ -1,31 +1,76 @@
+import warnings
+
 import matplotlib.pyplot as plt
+import numpy as np
+
+SAMPLE_SECS = 5
+LOG10_GB = 30 * np.log10(2)
 
-def as_gb(val):
-    if val == 0:
-        return 0
-    g = 0
-    factor = 1
-    while g == 0:
-        g = ((val * factor) >> 30) / factor
-        factor *= 10
-    return g
+# GiB with as many decimals as it takes for a small value not to show as 0:
+# ((val * factor) >> 30) / factor for the first factor of 1, 10, 100, ...
+# where that is not 0. log10 guesses the number of decimals, and the guess
+# is fixed up with the integer test itself.
+def as_gb(vals):
+    vals = np.asarray(vals, dtype=np.int64)
+    decs = np.zeros(vals.shape, dtype=np.int64)
+    pos = vals > 0
+    decs[pos] = np.maximum(np.ceil(LOG10_GB - np.log10(vals[pos])), 0)
+    decs[pos & ((vals * 10 ** decs) >> 30 == 0)] += 1
+    fewer = np.maximum(decs - 1, 0)
+    decs[(decs > 0) & ((vals * 10 ** fewer) >> 30 != 0)] -= 1
+    factor = 10 ** decs
+    return np.where(vals == 0, 0, ((vals * factor) >> 30) / factor)
 
-def normalize(stat, val):
-    v = int(val)
+def normalize(stat, vals):
     if "bytes" in stat:
-        return as_gb(v)
-    return v
+        return as_gb(vals)
+    return vals.astype(np.float64)
 
 def data_dir(workload, run):
     return f"results/{workload}/{run}"
 
+# One value per line, like int() on each line would take them. Depending on
+# the NumPy version, np.fromstring() stops at the first thing that is not a
+# number with only a warning, and it does not see blank lines, so the values
+# are counted against the lines.
+def read_dat(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    nr_lines = data.count(b"\n") + (1 if data and not data.endswith(b"\n") else 0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        vals = np.fromstring(data, dtype=np.int64, sep=" ")
+    if len(vals) != nr_lines:
+        raise ValueError(f"{path}: {nr_lines} lines but {len(vals)} values")
+    return vals
+
 def get_data(workload, run, stat):
     dir=data_dir(workload, run)
-    with open(f"{dir}/{stat}.dat", "r") as f:
-        ls = f.readlines()
-        return [normalize(stat, v) for v in ls]
+    return normalize(stat, read_dat(f"{dir}/{stat}.dat"))
 
-def make_plot(stat, runs):
+SERIES_DTYPE = [("workload", "U32"), ("stat", "U32"), ("run", "U32"), ("sample", np.int64), ("value", np.float64)]
+
+# Every sample of every workload, stat and run there is a .dat file for, as
+# one table.
+def load_results(workloads, stats, runs):
+    chunks = []
+    for workload in workloads:
+        for stat in stats:
+            for run in runs:
+                try:
+                    vals = get_data(workload, run, stat)
+                except FileNotFoundError:
+                    continue
+                chunk = np.empty(len(vals), dtype=SERIES_DTYPE)
+                chunk["workload"] = workload
+                chunk["stat"] = stat
+                chunk["run"] = run
+                chunk["sample"] = np.arange(len(vals))
+                chunk["value"] = vals
+                chunks.append(chunk)
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=SERIES_DTYPE)
+
+def make_plot(stat, rows):
     plt.xlabel("Time (sec)")
     ylabel = f"{stat}"
     if "bytes" in stat:
@@ -33,19 +78,19 @@ def make_plot(stat, runs):
     if "pct" in stat:
         plt.ylim([0, 100])
     plt.ylabel(ylabel)
-    for run, data in runs.items():
-        time=[t * 5 for t in range(len(data))]
-        plt.plot(time, data, label=run, marker=".")
+    for run in dict.fromkeys(rows["run"]):
+        data = rows[rows["run"] == run]
+        plt.plot(data["sample"] * SAMPLE_SECS, data["value"], label=run, marker=".")
     plt.legend(loc="upper left")
 
 def make_plots(data):
-    for workload, stats in data.items():
-        for stat, runs in stats.items():
-            if not runs:
-                continue
+    for workload in dict.fromkeys(data["workload"]):
+        rows = data[data["workload"] == workload]
+        for stat in dict.fromkeys(rows["stat"]):
             plt.figure()
-            make_plot(stat, runs)
+            make_plot(stat, rows[rows["stat"] == stat])
             plt.savefig(f"results/{workload}/{stat}.png")
+            plt.close()
 
 STATS = [
     "unalloc_bytes",
@@ -79,14 +124,4 @@ WORKLOADS = [
 ]
 
 if __name__ == "__main__":
-    data = {}
-    for workload in WORKLOADS:
-        data[workload] = {}
-        for stat in STATS:
-            data[workload][stat] = {}
-            for run in RUNS:
-                try:
-                    data[workload][stat][run] = get_data(workload, run, stat)
-                except FileNotFoundError:
-                    continue
-    make_plots(data)
+    make_plots(load_results(WORKLOADS, STATS, RUNS))
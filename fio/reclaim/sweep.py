@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+
+import argparse
+import csv
+from functools import partial
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import bg_sim
+import thresh_sim
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# sweep.py too, as run_point() and RESULTS make up what is cached
+SIM_SOURCES = ['bg_sim.py', 'thresh_sim.py', 'sweep.py']
+
+# The parameters of one point, in table order. The ones given as comma
+# separated lists on the command line are swept over.
+PARAMS = ['workload', 'run', 'size', 'target_frac', 'target_min', 'target_max', 'seed',
+          'bg_size', 'interleave', 'nrfiles', 'args']
+SWEPT = ['workload', 'run', 'size', 'target_frac', 'target_min', 'target_max', 'seed']
+RESULTS = ['reclaims', 'reclaim_bytes', 'enospc', 'ops', 'min_unalloc_bytes', 'max_thresh',
+           'final_alloc_pct', 'final_used_pct', 'seconds']
+
+# Results are only reused by the same simulator code.
+def code_version():
+    h = hashlib.sha1()
+    for name in SIM_SOURCES:
+        with open(os.path.join(HERE, name), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+def point_key(point, version):
+    blob = json.dumps(point, sort_keys=True) + version
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], f"{key}.json")
+
+def load_cached(cache_dir, key):
+    try:
+        with open(cache_path(cache_dir, key), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+# Written to a temporary name and renamed, so that a killed sweep never
+# leaves a half written result behind.
+def store_cached(cache_dir, key, result):
+    path = cache_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(result, f)
+    os.rename(f"{path}.tmp", path)
+
+def run_point(point):
+    args = argparse.Namespace(**point)
+    t = time.perf_counter()
+    sim = bg_sim.run_workload(args, point['run'])
+    series = sim.series
+    return {
+        'reclaims': sim.reclaims,
+        'reclaim_bytes': sim.reclaim_bytes,
+        'enospc': sim.enospc,
+        'ops': sim.ops,
+        'min_unalloc_bytes': int(np.min(series['unalloc_bytes'])),
+        'max_thresh': int(np.max(series['thresh'])),
+        'final_alloc_pct': series['alloc_pct'][-1],
+        'final_used_pct': series['used_pct'][-1],
+        'seconds': round(time.perf_counter() - t, 3),
+    }
+
+def run_keyed(cache_dir, key_point):
+    key, point = key_point
+    result = run_point(point)
+    store_cached(cache_dir, key, result)
+    return key, result
+
+def sweep_points(args):
+    swept = [args.workloads.split(','), args.runs.split(','),
+             [bg_sim.parse_size(s) for s in args.sizes.split(',')],
+             [float(v) for v in args.target_fracs.split(',')],
+             [float(v) for v in args.target_mins.split(',')],
+             [float(v) for v in args.target_maxs.split(',')],
+             [int(v) for v in args.seeds.split(',')]]
+    for vals in itertools.product(*swept):
+        point = dict(zip(SWEPT, vals))
+        if point['target_min'] > point['target_max']:
+            continue
+        point.update(bg_size=args.bg_size, interleave=args.interleave, nrfiles=args.nrfiles, args=[])
+        yield point
+
+def sweep(args):
+    version = code_version()
+    points = list(sweep_points(args))
+    keys = [point_key(point, version) for point in points]
+    results = {}
+    todo = []
+    for key, point in zip(keys, points):
+        cached = load_cached(args.cache, key)
+        if cached is None:
+            todo.append((key, point))
+        else:
+            results[key] = cached
+
+    t = time.perf_counter()
+    if todo:
+        with multiprocessing.Pool(args.jobs) as pool:
+            for i, (key, result) in enumerate(pool.imap_unordered(partial(run_keyed, args.cache), todo), 1):
+                results[key] = result
+                print(f"\r{i}/{len(todo)} points", end='', flush=True)
+        print()
+
+    with open(args.output, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(PARAMS + RESULTS)
+        for key, point in zip(keys, points):
+            row = [point[p] if p != 'args' else ' '.join(map(str, point[p])) for p in PARAMS]
+            w.writerow(row + [results[key][r] for r in RESULTS])
+    print(f"{len(points)} points, {len(points) - len(todo)} cached, {len(todo)} run in "
+          f"{time.perf_counter() - t:.1f}s, code {version}, written to {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep bg_sim.py over reclaim parameters, in parallel and cached.",
+                                     epilog="Options marked (list) take comma separated values; "
+                                            "every combination is one point.")
+    parser.add_argument('--workloads', default=','.join(bg_sim.WORKLOADS),
+                        help='(list) frag.sh workloads, with their default arguments')
+    parser.add_argument('--runs', default='free-30,per-30,free-dyn,per-dyn',
+                        help='(list) Reclaim configurations')
+    parser.add_argument('--sizes', default='100G',
+                        help='(list) Disk sizes (K/M/G/T suffixes allowed)')
+    parser.add_argument('--target-fracs', default=str(thresh_sim.TARGET_FRAC),
+                        help='(list) Unallocated targets of the dynamic threshold, as a fraction of the disk')
+    parser.add_argument('--target-mins', default=str(thresh_sim.TARGET_MIN),
+                        help='(list) Lower clamps of the target, in block groups')
+    parser.add_argument('--target-maxs', default=str(thresh_sim.TARGET_MAX),
+                        help='(list) Upper clamps of the target, in block groups')
+    parser.add_argument('--seeds', default='1',
+                        help='(list) Random seeds')
+    parser.add_argument('--bg-size', type=bg_sim.parse_size, default=1 << 30)
+    parser.add_argument('--interleave', type=bg_sim.parse_size, default=bg_sim.INTERLEAVE)
+    parser.add_argument('--nrfiles', type=int, default=bg_sim.NRFILES)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Worker processes')
+    parser.add_argument('--cache', default='sweep-cache',
+                        help='Directory of the results of each point, reused by later sweeps')
+    parser.add_argument('-o', '--output', default='sweep.csv',
+                        help='Table of every point of this sweep and its results')
+    sweep(parser.parse_args())
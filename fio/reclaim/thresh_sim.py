@@ -1,6 +1,22 @@
 #!/usr/bin/python3
 
+import argparse
+import contextlib
+import os
+
+import numpy as np
+
 DISK_SIZES = range(100, 1001, 100)
+ALLOC_STEPS = 20
+USED_STEPS = 10
+# The unallocated space to aim for: this fraction of the disk, clamped
+TARGET_FRAC = 0.05
+TARGET_MIN = 1
+TARGET_MAX = 5
+# The frag.sh series a run is replayed from, then the ones it is checked
+# against.
+SERIES = ['alloc_bytes', 'used_bytes', 'unalloc_bytes', 'thresh', 'reclaims', 'reclaim_bytes']
+CALIB_STATS = SERIES[3:]
 
 def clamp(val, lo, hi):
     if val < lo:
@@ -37,7 +53,7 @@ class Disk:
         self.reclaim_count += 1
 
     def calc_unalloc_target(self):
-        return clamp(self.size * 0.05, 1, 5)
+        return clamp(self.size * TARGET_FRAC, TARGET_MIN, TARGET_MAX)
 
     def calc_thresh(self):
         alloc = self.alloc
@@ -60,22 +76,225 @@ class Disk:
         print(f"would reclaim? {self} avg usage {usage} thresh {thresh} {usage < thresh}")
         return usage < thresh
 
-    def simulate_reclaims(self):
-        while self.would_reclaim():
-            self.reclaim_one()
+    # Reclaim until would_reclaim() stops holding. step walks there one
+    # reclaim_one() at a time, otherwise count_reclaims() jumps there.
+    def simulate_reclaims(self, step=False):
+        if step:
+            while self.would_reclaim():
+                self.reclaim_one()
+            return
+        n = int(count_reclaims(self.size, self.alloc, self.used))
+        self.alloc -= n
+        self.reclaim_count += n
+
+# Disk.calc_thresh() over arrays: size, alloc and used broadcast against
+# each other and the result has their broadcast shape.
+def calc_unalloc_targets(size, frac=TARGET_FRAC, lo=TARGET_MIN, hi=TARGET_MAX):
+    return np.clip(size * frac, lo, hi)
+
+def calc_threshes(size, alloc, used, target=(TARGET_FRAC, TARGET_MIN, TARGET_MAX)):
+    size, alloc, used = np.broadcast_arrays(*(np.asarray(v, dtype=np.float64) for v in (size, alloc, used)))
+    unused = alloc - used
+    unalloc = size - alloc
+    target = calc_unalloc_targets(size, *target)
+    want = np.maximum(0, target - unalloc)
+    can = unused > 0
+    raw = (can * want) / target
+    return np.clip(raw, 0, 1)
+
+# thresh is a fixed bg_reclaim_threshold as a fraction, or None for the
+# dynamic one.
+def would_reclaims(size, alloc, used, thresh=None):
+    if thresh is None:
+        thresh = calc_threshes(size, alloc, used)
+    return used / np.maximum(alloc, 1) < thresh
+
+# The number of reclaims Disk.simulate_reclaims() does from each starting
+# state. Each reclaim lowers alloc by 1, which only lowers the threshold
+# and raises the usage, so would_reclaim() holds for a prefix of the
+# reclaims and the end of it is found by bisection. It stops by the time
+# alloc reaches used, where there is nothing unused left and the threshold
+# is 0, or the usage reaches 1 above any fixed threshold.
+def count_reclaims(size, alloc, used, thresh=None):
+    size, alloc, used = np.broadcast_arrays(*(np.asarray(v) for v in (size, alloc, used)))
+    lo = np.zeros(alloc.shape, dtype=np.int64)
+    hi = np.ceil(np.maximum(alloc - used, 0)).astype(np.int64)
+    while True:
+        active = lo < hi
+        if not active.any():
+            return lo
+        mid = (lo + hi) // 2
+        more = would_reclaims(size, alloc - mid, used, thresh)
+        lo = np.where(active & more, mid + 1, lo)
+        hi = np.where(active & ~more, mid, hi)
+
+# The reclaim counts of the step by step loop, for checking count_reclaims().
+def step_reclaims(size, alloc, used):
+    counts = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for s, a, u in zip(size.ravel().tolist(), alloc.ravel().tolist(), used.ravel().tolist()):
+            d = Disk(s)
+            d.alloc = a
+            d.used = u
+            d.simulate_reclaims(step=True)
+            counts.append(d.reclaim_count)
+    return np.array(counts, dtype=np.int64).reshape(size.shape)
+
+# The threshold at every (disk size, alloc, used) point, with alloc in
+# alloc_steps steps of the disk size and used in used_steps steps of alloc,
+# as size x alloc x used arrays.
+def calc_all_threshes(sizes=DISK_SIZES, alloc_steps=ALLOC_STEPS, used_steps=USED_STEPS):
+    size = np.asarray(sizes, dtype=np.int64)[:, None, None]
+    alloc = size * np.arange(alloc_steps + 1)[None, :, None] // alloc_steps
+    used = alloc * np.arange(used_steps + 1)[None, None, :] // used_steps
+    size, alloc, used = np.broadcast_arrays(size, alloc, used)
+    return size, alloc, used, calc_threshes(size, alloc, used)
 
-def calc_all_threshes():
-    for disk in DISK_SIZES:
-        disk_step = max(1, int(disk / 20))
-        for alloc in range(0, disk + 1, disk_step):
-            alloc_step = max(1, int(alloc / 10))
-            for used in range(0, alloc + 1, alloc_step):
-                thresh = calc_thresh(disk, alloc, used)
-                print(f"disk {disk} alloc {alloc} used {used} thresh {thresh}")
+def save_surface(path, size, alloc, used, thresh):
+    reclaims = count_reclaims(size, alloc, used)
+    np.savez_compressed(path, size=size, alloc=alloc, used=used, thresh=thresh, reclaims=reclaims)
+
+# One read per .dat file of a frag.sh run. Stats it did not collect are left
+# out, frag.sh has reclaims and reclaim_bytes commented out, and the rest are
+# cut to the samples they all have, as the collect loop can be killed
+# between two of its writes.
+def load_series(run_dir):
+    series = {}
+    for stat in SERIES:
+        try:
+            with open(f"{run_dir}/{stat}.dat", 'r') as f:
+                series[stat] = np.array(f.read().split(), dtype=np.int64)
+        except FileNotFoundError:
+            continue
+    n = min((len(vals) for vals in series.values()), default=0)
+    return {stat: vals[:n] for stat, vals in series.items()}
+
+# The fixed threshold of a frag.sh run name as a fraction, None for the
+# dynamic ones. bg_sim.py runs are named sim-<run>.
+def run_thresh(run):
+    kind, thresh = run.removeprefix('sim-').split('-')
+    if kind not in ('free', 'per'):
+        raise ValueError(f"unknown reclaim policy {run}")
+    return None if thresh == 'dyn' else int(thresh) / 100
+
+# Replay a run's observed alloc and used through the model: at each sample
+# where they changed, it reclaims as Disk.simulate_reclaims() does, each
+# reclaim relocating a block group at the average usage, and those reclaims
+# show up by the next sample. The observed alloc never has the model's
+# reclaims in it, so they are carried forward as pending, taken off the
+# alloc the model starts from, until the observed alloc has dropped by as
+# much. The disk is what data has allocated plus what is unallocated,
+# metadata and system chunks are in neither.
+def replay(series, thresh, bg_size):
+    alloc = series['alloc_bytes'] / bg_size
+    used = series['used_bytes'] / bg_size
+    size = alloc + series['unalloc_bytes'] / bg_size
+    changed = np.ones(alloc.shape, dtype=bool)
+    changed[1:] = (alloc[1:] != alloc[:-1]) | (used[1:] != used[:-1])
+    dropped = np.maximum(0, np.concatenate(([0], alloc[:-1] - alloc[1:])))
+    n = np.zeros(len(alloc), dtype=np.int64)
+    moved = np.zeros(len(alloc))
+    pending = 0
+    for i in np.flatnonzero(changed).tolist():
+        pending = max(0, pending - dropped[i])
+        start = max(alloc[i] - pending, used[i])
+        n[i] = count_reclaims(size[i], start, used[i], thresh)
+        # reclaim k is of a block group at used / (start - k)
+        k = np.arange(n[i])
+        moved[i] = (used[i] / np.maximum(start - k, 1)).sum() * bg_size
+        pending += n[i]
+    if thresh is None:
+        thresh = calc_threshes(size, alloc, used)
+    else:
+        thresh = np.full(alloc.shape, thresh)
+    return {
+        'thresh': (100 * thresh).astype(np.int64),
+        'reclaims': np.concatenate(([0], np.cumsum(n)[:-1])),
+        'reclaim_bytes': np.concatenate(([0], np.cumsum(moved)[:-1])).astype(np.int64),
+    }
+
+# Compare the replay of every run under results/<workload>/<run>/ with what
+# it measured, sample by sample. reclaims and reclaim_bytes are counted from
+# the first sample.
+def calibrate(results, bg_size):
+    totals = {stat: [0, 0, 0] for stat in CALIB_STATS}
+    print("calib workload run stat samples mean_err max_err measured sim")
+    for workload in sorted(os.listdir(results)):
+        wdir = os.path.join(results, workload)
+        if not os.path.isdir(wdir):
+            continue
+        for run in sorted(os.listdir(wdir)):
+            rdir = os.path.join(wdir, run)
+            try:
+                thresh = run_thresh(run)
+            except ValueError:
+                continue
+            series = load_series(rdir)
+            if not all(stat in series for stat in SERIES[:3]) or not len(series['alloc_bytes']):
+                print(f"calib {workload} {run} no alloc/used series")
+                continue
+            model = replay(series, thresh, bg_size)
+            for stat in CALIB_STATS:
+                if stat not in series:
+                    print(f"calib {workload} {run} {stat} not collected")
+                    continue
+                measured = series[stat] if stat == 'thresh' else series[stat] - series[stat][0]
+                err = np.abs(model[stat] - measured)
+                print(f"calib {workload} {run} {stat} {len(err)} {err.mean():.1f} {err.max()} "
+                      f"{measured[-1]} {model[stat][-1]}")
+                totals[stat][0] += 1
+                totals[stat][1] += len(err)
+                totals[stat][2] += int(err.sum())
+    for stat, (runs, samples, err) in totals.items():
+        mean = err / samples if samples else 0
+        print(f"stat {stat} runs {runs} samples {samples} mean_err {mean:.1f}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the dynamic reclaim threshold.")
+    parser.add_argument('--surface', metavar='FILE',
+                        help='Save the threshold and the reclaim count over a grid of disk sizes, allocs and useds to FILE (.npz)')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check the reclaim counts over the grid against the step by step simulation')
+    parser.add_argument('--calibrate', metavar='RESULTS',
+                        help='Replay the runs in RESULTS/<workload>/<run>/ of frag.sh and report how far the '
+                             'model is from their measured thresh, reclaims and reclaim_bytes')
+    parser.add_argument('--bg-size', type=int, default=1 << 30,
+                        help='Block group size in bytes, the unit of the model, for --calibrate')
+    parser.add_argument('--step', action='store_true',
+                        help='Simulate the example disk one reclaim at a time')
+    parser.add_argument('--sizes', default=f'{DISK_SIZES.start}:{DISK_SIZES.stop}:{DISK_SIZES.step}',
+                        help='Disk sizes of the grid, as start:stop:step')
+    parser.add_argument('--alloc-steps', type=int, default=ALLOC_STEPS,
+                        help='Steps of alloc from 0 to the disk size')
+    parser.add_argument('--used-steps', type=int, default=USED_STEPS,
+                        help='Steps of used from 0 to alloc')
+    args = parser.parse_args()
+
+    if args.surface:
+        sizes = range(*map(int, args.sizes.split(':')))
+        size, alloc, used, thresh = calc_all_threshes(sizes, args.alloc_steps, args.used_steps)
+        save_surface(args.surface, size, alloc, used, thresh)
+        print(f"{thresh.size} points, {np.count_nonzero(thresh)} with a threshold, saved to {args.surface}")
+        exit(0)
+
+    if args.calibrate:
+        calibrate(args.calibrate, args.bg_size)
+        exit(0)
+
+    if args.verify:
+        sizes = range(*map(int, args.sizes.split(':')))
+        size, alloc, used, _ = calc_all_threshes(sizes, args.alloc_steps, args.used_steps)
+        jumped = count_reclaims(size, alloc, used)
+        stepped = step_reclaims(size, alloc, used)
+        bad = np.flatnonzero(jumped.ravel() != stepped.ravel())
+        for i in bad[:10]:
+            print(f"size {size.flat[i]} alloc {alloc.flat[i]} used {used.flat[i]} "
+                  f"reclaims {jumped.flat[i]} step {stepped.flat[i]}")
+        print(f"{len(bad)} of {jumped.size} points differ, {int(stepped.sum())} reclaims")
+        exit(1 if len(bad) else 0)
+
     d = Disk(10)
     d.use(10)
     d.free(5)
-    d.simulate_reclaims()
+    d.simulate_reclaims(step=args.step)
     print(f"{d} reclaims: {d.reclaim_count}")
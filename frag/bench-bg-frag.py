@@ -0,0 +1,141 @@
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ANALYZER = os.path.join(HERE, 'process-bg-frag.py')
+GENERATOR = os.path.join(HERE, 'gen-bg-frag.py')
+
+COUNT_SUFFIXES = {'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9}
+MODES = ['line', 'stream', 'bulk', 'cache']
+
+def parse_count(s):
+    mult = COUNT_SUFFIXES.get(s[-1:].upper())
+    if mult is None:
+        return int(s)
+    return int(float(s[:-1]) * mult)
+
+def load_analyzer():
+    spec = importlib.util.spec_from_file_location('process_bg_frag', ANALYZER)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+def dump_path(args, size):
+    return os.path.join(args.dir, f"bg-frag-{size}.out")
+
+def make_dump(args, size):
+    path = dump_path(args, size)
+    if not os.path.exists(path):
+        cmd = [sys.executable, GENERATOR, '--lines', str(parse_count(size)),
+               '--seed', str(args.seed), '-o', path + '.tmp'] + args.gen_args
+        subprocess.run(cmd, check=True)
+        os.rename(path + '.tmp', path)
+    return path
+
+# Run one mode over one dump in this process. finish() is called from inside
+# the parsers, so it is timed by wrapping BlockGroup.finish and the parse
+# time is what is left of the whole loop after finish and report.
+def bench_one(mode, fmt, frag_file):
+    pbf = load_analyzer()
+    timers = {'finish': 0.0, 'report': 0.0}
+    finish = pbf.BlockGroup.finish
+    def timed_finish(bg):
+        t = time.perf_counter()
+        finish(bg)
+        timers['finish'] += time.perf_counter() - t
+    pbf.BlockGroup.finish = timed_finish
+
+    tmpdir = tempfile.TemporaryDirectory()
+    writer = pbf.REPORTS[fmt](tmpdir.name if fmt == 'npy' else os.devnull)
+    def report(bg):
+        t = time.perf_counter()
+        writer.add(bg)
+        timers['report'] += time.perf_counter() - t
+
+    t = time.perf_counter()
+    if mode == 'line':
+        with open(frag_file, 'r') as f:
+            bgs = pbf.process_frag_lines(f)
+        for bg in bgs.values():
+            report(bg)
+    else:
+        if mode == 'stream':
+            bgs = pbf.stream_frag_lines(open(frag_file, 'r'))
+        elif mode == 'bulk':
+            bgs = pbf.stream_frag_bulk(open(frag_file, 'rb'))
+        else:
+            recs = pbf.load_or_build_cache(frag_file)
+            bgs = pbf.frag_records_bgs(recs, 0, len(recs['type']))
+        for bg in bgs:
+            report(bg)
+    t_close = time.perf_counter()
+    writer.close()
+    timers['report'] += time.perf_counter() - t_close
+    total = time.perf_counter() - t
+    tmpdir.cleanup()
+
+    with open(frag_file, 'rb') as f:
+        nr_lines = sum(block.count(b'\n') for block in pbf.read_blocks(f))
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'lines': nr_lines,
+        'parse': total - timers['finish'] - timers['report'],
+        'finish': timers['finish'],
+        'report': timers['report'],
+        'total': total,
+        'lines_per_s': int(nr_lines / total),
+        'rss_mb': rss // 1024,
+    }
+
+# Each run gets a fresh interpreter so its peak RSS is its own.
+def bench(args):
+    os.makedirs(args.dir, exist_ok=True)
+    results = open(args.results, 'a') if args.results else None
+    print("size mode lines parse finish report total lines/s rss_mb")
+    for size in args.sizes.split(','):
+        frag_file = make_dump(args, size)
+        for mode in args.modes.split(','):
+            if mode == 'cache' and not args.warm:
+                shutil.rmtree(frag_file + '.cache', ignore_errors=True)
+            cmd = [sys.executable, os.path.abspath(__file__), '--child', mode, args.format, frag_file]
+            out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout
+            r = json.loads(out)
+            print(f"{size} {mode} {r['lines']} {r['parse']:.2f} {r['finish']:.2f} {r['report']:.2f} "
+                  f"{r['total']:.2f} {r['lines_per_s']} {r['rss_mb']}", flush=True)
+            if results:
+                r.update(size=size, mode=mode, format=args.format, time=int(time.time()))
+                results.write(json.dumps(r) + '\n')
+    if results:
+        results.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark process-bg-frag.py on synthetic dumps.",
+                                     epilog="Other options are passed to gen-bg-frag.py.")
+    parser.add_argument('--sizes', default='1M,10M,100M',
+                        help='Comma separated dump sizes in lines (K/M/G suffixes allowed)')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help=f"Comma separated analyzer modes out of {','.join(MODES)}")
+    parser.add_argument('--dir', default='.',
+                        help='Where to keep the generated dumps, they are reused if present')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--warm', action='store_true',
+                        help='Reuse an existing dump cache for the cache mode instead of timing its build')
+    parser.add_argument('--results', metavar='FILE',
+                        help='Also append each run as a JSON line to FILE, to compare across commits')
+    parser.add_argument('--format', default='text',
+                        help='Report format to time, as process-bg-frag.py --format')
+    parser.add_argument('--child', nargs=3, metavar=('MODE', 'FORMAT', 'DUMP'), help=argparse.SUPPRESS)
+    args, gen_args = parser.parse_known_args()
+    args.gen_args = gen_args
+    if args.child:
+        print(json.dumps(bench_one(*args.child)))
+    else:
+        bench(args)
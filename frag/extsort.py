@@ -0,0 +1,112 @@
+import argparse
+import collections
+import heapq
+import multiprocessing
+import os
+import sys
+import tempfile
+
+RECORD_TYPES = {"EXTENT-SHARED-REF", "EXTENT-RESOLVED-REF", "FREE", "BG-DONE", "METADATA-ITEM"}
+
+# Python lines, their keys and the list holding them take about this many
+# times the size of the text.
+SORT_OVERHEAD = 6
+
+# Sort key of a bg-frag.btrd line: block group, then offset, with each
+# BG-DONE after the rest of its block group. A leading sort key column, as
+# in the event streams sort-stream.sh handles, is skipped. Lines that are
+# not records get None and are dropped.
+def frag_line_key(line):
+    cols = line.split()
+    if len(cols) > 1 and cols[0] not in RECORD_TYPES:
+        cols = cols[1:]
+    if len(cols) < 4 or cols[0] not in RECORD_TYPES:
+        return None
+    try:
+        return (int(cols[1]), cols[0] == "BG-DONE", int(cols[2]))
+    except ValueError:
+        return None
+
+def sort_lines(lines, key):
+    keyed = [(k, line) for line in lines if (k := key(line)) is not None]
+    keyed.sort(key=lambda kl: kl[0])
+    return [line for _, line in keyed]
+
+def write_run(lines, key, path):
+    with open(path, 'w') as f:
+        for line in sort_lines(lines, key):
+            f.write(line)
+    return path
+
+def read_run(path):
+    with open(path, 'r', buffering=1 << 16) as f:
+        yield from f
+
+def readlines(lines, nr_bytes):
+    size = 0
+    for line in lines:
+        if not line.endswith('\n'):
+            line += '\n'
+        yield line
+        size += len(line)
+        if size >= nr_bytes:
+            return
+
+def read_chunks(lines, nr_bytes):
+    lines = iter(lines)
+    while True:
+        chunk = list(readlines(lines, nr_bytes))
+        if not chunk:
+            return
+        yield chunk
+
+# Sort lines with at most about memory bytes of them in memory. The input is
+# cut into runs that are sorted by jobs worker processes and written to
+# tmpdir, then merged through a heap as the caller consumes them, so the
+# sorted output is never written anywhere. Lines with equal keys keep their
+# input order. key must be a module level function for the workers.
+def external_sort(lines, key=frag_line_key, memory=1 << 30, jobs=1, tmpdir=None):
+    run_bytes = max(memory // (SORT_OVERHEAD * (jobs + 1)), 1 << 20)
+    pool = rundir = None
+    runs = []
+    pending = collections.deque()
+    try:
+        # a chunk is only sent off once the next one shows the input does not
+        # fit in one run, which is then sorted in memory instead
+        chunk = None
+        for next_chunk in read_chunks(lines, run_bytes):
+            if chunk is not None:
+                if pool is None:
+                    rundir = tempfile.TemporaryDirectory(prefix='extsort.', dir=tmpdir)
+                    pool = multiprocessing.Pool(jobs)
+                if len(pending) >= jobs:
+                    runs.append(pending.popleft().get())
+                path = os.path.join(rundir.name, f'run{len(runs) + len(pending)}')
+                pending.append(pool.apply_async(write_run, (chunk, key, path)))
+            chunk = next_chunk
+        if pool is None:
+            yield from sort_lines(chunk or [], key)
+            return
+        path = os.path.join(rundir.name, f'run{len(runs) + len(pending)}')
+        pending.append(pool.apply_async(write_run, (chunk, key, path)))
+        chunk = None
+        runs += [result.get() for result in pending]
+        pool.close()
+        yield from heapq.merge(*(read_run(path) for path in runs), key=key)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if rundir is not None:
+            rundir.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sort bg-frag.btrd output by block group and offset in bounded memory.")
+    parser.add_argument('-m', '--memory', type=int, default=1024, metavar='MB',
+                        help='About how much memory the runs being sorted may take')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Sort this many runs at once')
+    parser.add_argument('-T', '--tmpdir', help='Where to write the sorted runs')
+    parser.add_argument('frag_file', nargs='?', default='-', metavar='bg-frag.out')
+    args = parser.parse_args()
+    f = sys.stdin if args.frag_file == '-' else open(args.frag_file, 'r')
+    sys.stdout.writelines(external_sort(f, memory=args.memory << 20, jobs=args.jobs, tmpdir=args.tmpdir))
@@ -0,0 +1,173 @@
+import argparse
+import math
+import sys
+
+import numpy as np
+
+SECTORSIZE = 4096
+NODESIZE = 16384
+FIRST_SUBVOL = 256
+FIRST_INO = 257
+EXTENT_TREE = 2
+CSUM_TREE = 7
+MAX_LEVEL = 8
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parse_size(s):
+    mult = SIZE_SUFFIXES.get(s[-1:].upper())
+    if mult is None:
+        return int(s)
+    return int(float(s[:-1]) * mult)
+
+def round_sectors(vals):
+    return np.maximum(vals // SECTORSIZE, 1).astype(np.int64) * SECTORSIZE
+
+# Extent lengths are log-uniform between min_extent and max_extent, so every
+# power of two size class gets about the same number of extents.
+def extent_lens(rng, n, args):
+    lo, hi = math.log(args.min_extent), math.log(args.max_extent)
+    return np.clip(round_sectors(np.exp(rng.uniform(lo, hi, n))), args.min_extent, args.max_extent)
+
+def mean_extent(args):
+    lo, hi = args.min_extent, args.max_extent
+    if hi <= lo:
+        return lo
+    return (hi - lo) / math.log(hi / lo)
+
+# Lay out one block group: each extent is preceded by a free gap with
+# probability free_frag, sized so that about free_pct of the block group
+# ends up free. Whatever is left after the last extent is free too.
+def layout_bg(rng, args):
+    free = args.free_pct / 100
+    used_max = int(args.bg_size * (1 - free))
+    mean = mean_extent(args)
+    gap_mean = 0
+    if args.free_frag > 0 and free > 0:
+        gap_mean = free / max(1 - free, 1e-9) * mean / args.free_frag
+    n = int(used_max / mean * 1.2) + 64
+    lens = extent_lens(rng, n, args)
+    gaps = np.zeros(n, dtype=np.int64)
+    if gap_mean > 0:
+        holes = rng.random(n) < args.free_frag
+        gaps[holes] = round_sectors(rng.exponential(gap_mean, int(holes.sum())))
+    ends = np.cumsum(gaps + lens)
+    keep = (ends <= args.bg_size) & (np.cumsum(lens) <= used_max)
+    n = int(np.argmin(keep)) if not keep.all() else n
+    return gaps[:n], lens[:n], ends[:n] - lens[:n]
+
+def bg_lines(rng, bg_start, args):
+    gaps, lens, offs = layout_bg(rng, args)
+    n = len(lens)
+    offs = offs + bg_start
+    shared = (rng.random(n) < args.shared).tolist()
+    nr_refs = np.where(rng.random(n) < args.reflink, 2, 1)
+    nr_owners = nr_refs.sum()
+    trees = rng.integers(0, args.trees, nr_owners)
+    trees = np.where(trees == 0, 5, FIRST_SUBVOL + trees - 1).tolist()
+    inos = (FIRST_INO + rng.integers(0, args.files, nr_owners)).tolist()
+    file_offs = (SECTORSIZE * rng.integers(0, 1 << 18, nr_owners)).tolist()
+    leaves = (NODESIZE * rng.integers(1, args.leaves + 1, n)).tolist()
+    lines = []
+    ref = 0
+    for i, (gap, off, l, refs) in enumerate(zip(gaps.tolist(), offs.tolist(), lens.tolist(), nr_refs.tolist())):
+        if gap:
+            lines.append(f"FREE {bg_start} {off - gap} {gap}")
+        if shared[i]:
+            lines.append(f"EXTENT-SHARED-REF {bg_start} {off} {l} {leaves[i]}")
+        else:
+            for r in range(ref, ref + refs):
+                lines.append(f"EXTENT-RESOLVED-REF {bg_start} {off} {l} {trees[r]} {inos[r]} {file_offs[r]}")
+        ref += refs
+    end = offs[-1] + lens[-1] if n else bg_start
+    if end < bg_start + args.bg_size:
+        lines.append(f"FREE {bg_start} {end} {bg_start + args.bg_size - end}")
+    lines.append(f"BG-DONE {bg_start} {bg_start} {args.bg_size}")
+    return lines
+
+# A metadata block group holds tree blocks of NODESIZE laid out like data
+# extents of that one size. The extent and csum trees and the subvolume
+# trees own them in runs: each block starts a new run with probability
+# meta_scatter. A block is a leaf 99% of the time and each level up is 100
+# times rarer.
+def metadata_bg_lines(rng, bg_start, args):
+    meta_args = argparse.Namespace(**{**vars(args), 'min_extent': NODESIZE, 'max_extent': NODESIZE})
+    gaps, lens, offs = layout_bg(rng, meta_args)
+    n = len(lens)
+    offs = offs + bg_start
+    roots = np.array([EXTENT_TREE, CSUM_TREE, 5] + [FIRST_SUBVOL + t for t in range(args.trees - 1)])
+    new_run = rng.random(n) < args.meta_scatter
+    if n:
+        new_run[0] = True
+    picks = roots[rng.integers(0, len(roots), n)]
+    trees = picks[np.flatnonzero(new_run)[np.cumsum(new_run) - 1]].tolist() if n else []
+    levels = np.minimum(rng.geometric(0.99, n) - 1, MAX_LEVEL - 1).tolist()
+    lines = []
+    for gap, off, tree, level in zip(gaps.tolist(), offs.tolist(), trees, levels):
+        if gap:
+            lines.append(f"FREE {bg_start} {off - gap} {gap}")
+        lines.append(f"METADATA-ITEM {bg_start} {off} {NODESIZE} {tree} {level}")
+    end = offs[-1] + lens[-1] if n else bg_start
+    if end < bg_start + args.bg_size:
+        lines.append(f"FREE {bg_start} {end} {bg_start + args.bg_size - end}")
+    lines.append(f"BG-DONE {bg_start} {bg_start} {args.bg_size}")
+    return lines
+
+def gen_frag(args, out):
+    rng = np.random.default_rng(args.seed)
+    nr_lines = 0
+    i = 0
+    while (args.lines and nr_lines < args.lines) or (not args.lines and i < args.bgs):
+        make_lines = bg_lines
+        if args.metadata_pct and rng.random() * 100 < args.metadata_pct:
+            make_lines = metadata_bg_lines
+        lines = make_lines(rng, args.first_bg + i * args.bg_size, args)
+        out.write('\n'.join(lines))
+        out.write('\n')
+        nr_lines += len(lines)
+        i += 1
+    return i, nr_lines
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic bg-frag.btrd dump.")
+    parser.add_argument('--bgs', type=int, default=16,
+                        help='Number of block groups')
+    parser.add_argument('--lines', type=int, default=0,
+                        help='Instead of --bgs, add block groups until the dump has at least N lines')
+    parser.add_argument('--bg-size', type=parse_size, default=1 << 30,
+                        help='Block group length (K/M/G suffixes allowed)')
+    parser.add_argument('--first-bg', type=parse_size, default=1 << 30,
+                        help='Start of the first block group')
+    parser.add_argument('--min-extent', type=parse_size, default=SECTORSIZE,
+                        help='Smallest extent length')
+    parser.add_argument('--max-extent', type=parse_size, default=1 << 20,
+                        help='Largest extent length, lengths are log-uniform in between')
+    parser.add_argument('--shared', type=float, default=0.1,
+                        help='Fraction of the extents with a shared (EXTENT-SHARED-REF) ref')
+    parser.add_argument('--reflink', type=float, default=0.05,
+                        help='Fraction of the other extents with a second resolved ref')
+    parser.add_argument('--free-pct', type=float, default=30,
+                        help='Percent of each block group that is free')
+    parser.add_argument('--free-frag', type=float, default=0.3,
+                        help='Chance of a free gap before each extent, 0 puts all free space at the end')
+    parser.add_argument('--trees', type=int, default=3,
+                        help='Number of subvolumes owning the extents')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='Number of inodes per subvolume')
+    parser.add_argument('--leaves', type=int, default=1000,
+                        help='Number of distinct shared ref leaves')
+    parser.add_argument('--metadata-pct', type=float, default=0,
+                        help='Percent of the block groups that hold tree blocks (METADATA-ITEM) instead of data')
+    parser.add_argument('--meta-scatter', type=float, default=0.3,
+                        help='Chance that a tree block is owned by a different tree than the one before it')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='Write the dump here instead of stdout')
+    args = parser.parse_args()
+    if args.min_extent < SECTORSIZE or args.max_extent < args.min_extent:
+        parser.error(f"need {SECTORSIZE} <= --min-extent <= --max-extent")
+    if not 0 <= args.free_pct < 100:
+        parser.error("--free-pct must be in [0, 100)")
+    out = open(args.output, 'w') if args.output else sys.stdout
+    nr_bgs, nr_lines = gen_frag(args, out)
+    out.close()
+    print(f"{nr_bgs} block groups {nr_lines} lines", file=sys.stderr)
@@ -1,120 +1,339 @@
+import argparse
+import bisect
 import collections
-import statistics
+import cProfile
+from array import array
+from functools import partial
+import hashlib
+import heapq
+import json
+import mmap
+import multiprocessing
+import os
+import pstats
+import shutil
 import sys
+import time
+import warnings
+
+import numpy as np
 
 SHARED_EXTENT = "EXTENT-SHARED-REF"
 NORMAL_EXTENT = "EXTENT-RESOLVED-REF"
 FREE = "FREE"
 BG_DONE = "BG-DONE"
+METADATA_ITEM = "METADATA-ITEM"
 
-class SharedExtent:
-    def __init__(self, bg, off, l, ref_off):
-        self.bg = bg
-        self.off = off
-        self.len = l
-        self.ref_off = ref_off;
-    def owner(self):
-        return f"{self.ref_off}"
-
-class NormalExtent:
-    def __init__(self, bg, off, l, tree, ino, file_off):
-        self.bg = bg
-        self.off = off
-        self.len = l
-        self.tree = tree
-        self.ino = ino
-        self.file_off = file_off
-    def owner(self):
-        return f"{self.tree}:{self.ino}"
-
-class ContiguousUsed:
-    def __init__(self, first_extent):
-        self.bg = first_extent.bg;
-        self.off = first_extent.off
-        self.extents = []
-        self.len = 0
-        self.owners = set()
+SHARED_KIND = 0
+NORMAL_KIND = 1
+FREE_KIND = 2
+BG_DONE_KIND = 3
+METADATA_KIND = 4
 
-    def add_extent(self, extent):
-        self.extents.append(extent)
-        self.owners.add(extent.owner())
-        self.len += extent.len
-        extent.contig = self.id()
+# Extent owners are interned as small integer ids instead of formatted
+# strings. An owner's key is (kind, a, b): a shared ref is owned by the
+# tree block at its ref_off (a), a normal ref by its tree:ino (a:b) and a
+# tree block by its tree (a). A block group numbers its own owners from
+# its extent columns when it is finished, and only an OwnerIndex keeps a
+# table for the whole dump (see OwnerIds).
 
-    def id(self):
-        return f"{self.bg}:{self.off}"
+# The kind, a and b columns of a list of keys.
+def key_columns(keys):
+    keys = np.array(keys, dtype=np.uint64).reshape(-1, 3)
+    return keys[:, 0], keys[:, 1], keys[:, 2]
 
-    def __repr__(self):
-        return f"CONTIG({self.bg},{self.off},{self.len})"
+def owner_name(key):
+    kind, a, b = key
+    if kind == NORMAL_KIND:
+        return f"{a}:{b}"
+    if kind == METADATA_KIND:
+        return f"tree:{a}"
+    return f"{a}"
+
+# The owner table of a whole dump. Owners are looked up a block group at a
+# time, through dicts keyed by plain ints: by ref_off, by tree and, for the
+# files, by tree and then ino. So only the owners that are new get their
+# keys built as tuples. Owners are only added through lookup().
+class OwnerIds:
+    def __init__(self):
+        self.by_key = {SHARED_KIND: {}, METADATA_KIND: {}}
+        self.files = {}
+        self.keys = []
+        self.kinds = array('B')
+
+    # The ids of the owners (kind, a, b), interning the new ones in the
+    # order of first.
+    def lookup(self, kind, a, b, first):
+        ids = np.full(len(kind), -1, dtype=np.int64)
+        for k, by_key in self.by_key.items():
+            rows = np.flatnonzero(kind == k)
+            ids[rows] = [by_key.get(key, -1) for key in a[rows].tolist()]
+        rows = np.flatnonzero(kind == NORMAL_KIND)
+        trees, tree_inv = np.unique(a[rows], return_inverse=True)
+        rows = rows[np.argsort(tree_inv, kind='stable')]
+        bounds = np.searchsorted(np.sort(tree_inv), np.arange(len(trees) + 1))
+        for tree, lo, hi in zip(trees.tolist(), bounds[:-1].tolist(), bounds[1:].tolist()):
+            by_ino = self.files.setdefault(tree, {})
+            ids[rows[lo:hi]] = [by_ino.get(ino, -1) for ino in b[rows[lo:hi]].tolist()]
+
+        new = np.flatnonzero(ids < 0)
+        new = new[np.argsort(first[new], kind='stable')]
+        ids[new] = len(self.keys) + np.arange(len(new))
+        for iden, key in zip(ids[new].tolist(), zip(kind[new].tolist(), a[new].tolist(), b[new].tolist())):
+            if key[0] == NORMAL_KIND:
+                self.files[key[1]][key[2]] = iden
+            else:
+                self.by_key[key[0]][key[1]] = iden
+            self.keys.append(key)
+        self.kinds.extend(kind[new].tolist())
+        return ids
+
+    def key_columns(self):
+        return key_columns(self.keys)
+
+    def name(self, iden):
+        return owner_name(self.keys[iden])
+
+HIST_MIN = 4096
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parse_size(s):
+    mult = SIZE_SUFFIXES.get(s[-1:].upper())
+    if mult is None:
+        return int(s)
+    return int(float(s[:-1]) * mult)
 
-class FreeExtent:
-    def __init__(self, bg, off, l):
-        self.bg = bg
-        self.off = off
-        self.len = l
+# An array() or NumPy column as an int64 NumPy array.
+def column(col):
+    return np.asarray(col, dtype=np.int64)
+
+# Bucket i of a histogram holds the values in (HIST_MIN << (i - 1), HIST_MIN << i],
+# with everything up to HIST_MIN in bucket 0. The bucket is the bit length of
+# val - 1, which frexp gives exactly, where rounding log2 would not.
+def hist_buckets(vals):
+    _, bits = np.frexp((np.maximum(vals, 1) - 1).astype(np.float64))
+    return np.maximum(bits - (HIST_MIN.bit_length() - 1), 0)
+
+def hist_dict(counts):
+    return {HIST_MIN << i: int(c) for i, c in enumerate(counts)}
 
 def compute_hist(vals):
-    hist = {}
-    step = 4096
-    hist[step] = 0
-    for val in vals:
-        while step < val:
-            step *= 2
-            hist[step] = 0
-        hist[step] += 1
-    return hist
+    return hist_dict(np.bincount(hist_buckets(vals), minlength=1))
+
+# A length histogram fine enough for quantiles: each power of two is split
+# into 2^SKETCH_SUB_BITS buckets, so a quantile is off by at most 1/16 of
+# its value, and values below 2^SKETCH_SUB_BITS get a bucket each. Bucket
+# m << e, for m in [16, 32), holds [m << e, (m + 1) << e).
+SKETCH_SUB_BITS = 4
+SKETCH_BUCKETS = (64 - SKETCH_SUB_BITS + 1) << SKETCH_SUB_BITS
+
+def sketch_buckets(vals):
+    _, bits = np.frexp(np.maximum(vals, 0).astype(np.float64))
+    shift = np.maximum(bits - SKETCH_SUB_BITS - 1, 0)
+    return (shift << SKETCH_SUB_BITS) + (vals >> shift)
+
+def sketch_bucket_low(bucket):
+    shift = max((bucket >> SKETCH_SUB_BITS) - 1, 0)
+    return (bucket - (shift << SKETCH_SUB_BITS)) << shift
+
+# A fixed size, mergeable summary of a set of lengths. Only the buckets in
+# use are kept, so one per block group stays small, and merging the sketches
+# of any split of the lengths gives the sketch of all of them.
+class LenSketch:
+    def __init__(self, vals=None):
+        self.buckets = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.max = 0
+        if vals is not None and len(vals) > 0:
+            self.buckets, self.counts = np.unique(sketch_buckets(vals), return_counts=True)
+            self.max = int(vals.max())
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def merge(self, other):
+        if len(other.counts) == 0:
+            return
+        counts = np.zeros(SKETCH_BUCKETS, dtype=np.int64)
+        counts[self.buckets] += self.counts
+        counts[other.buckets] += other.counts
+        self.buckets = np.flatnonzero(counts)
+        self.counts = counts[self.buckets]
+        self.max = max(self.max, other.max)
+
+    # The low end of the bucket holding the q quantile, or 0 if empty.
+    def quantile(self, q):
+        if len(self.counts) == 0:
+            return 0
+        cum = np.cumsum(self.counts)
+        i = int(np.searchsorted(cum, max(q * cum[-1], 1)))
+        return min(sketch_bucket_low(int(self.buckets[i])), self.max)
+
+    def __repr__(self):
+        return ' '.join(f'p{int(q * 100)} {self.quantile(q)}' for q in (0.5, 0.9, 0.99)) + f' max {self.max}'
 
+# np.unique() of (x, y) rows. Sorting rows is slow, so when it fits the pair
+# is packed into one int64 through the index of x among its few values.
+def unique_pairs(x, y):
+    xs, xi = np.unique(x, return_inverse=True)
+    span = int(y.max()) + 1 if len(y) > 0 else 1
+    if len(xs) * span >= 1 << 63:
+        keys, inv = np.unique(np.stack((x, y), axis=1), axis=0, return_inverse=True)
+        return keys, inv.reshape(-1)
+    packed, inv = np.unique(xi * span + y.astype(np.int64), return_inverse=True)
+    return np.stack((xs[packed // span], (packed % span).astype(y.dtype)), axis=1), inv
+
+# The extents, free extents and contiguous used runs of a block group are
+# kept in typed columns rather than as one Python object each. Extent i is
+# (ext_kind[i], ext_off[i], ext_len[i], ...) and lives in contig ext_contig[i].
+# ext_ref_off is the file offset of a normal ref, the parent of a shared one
+# and the level of a tree block. ext_owner is an id among the block group's
+# own owners, set by finish(), see owner_columns().
 class BlockGroup:
     def __init__(self, start):
         self.start = start
         # computed as we add extents
         self.max_free = 0
-        self.free_extents = []
-        self.extents = []
-        self.contigs = []
         self.off = 0
         self.free = 0
-        self.contig = None
-
-    def add_shared(self, shared):
-        if not self.contig:
-            self.contig = ContiguousUsed(shared)
-        self.contig.add_extent(shared)
-        self.off += shared.len
-        self.extents.append(shared)
-
-    def add_normal(self, normal):
-        if not self.contig:
-            self.contig = ContiguousUsed(normal)
-        self.contig.add_extent(normal)
-        self.off += normal.len
-        self.extents.append(normal)
-
-    def add_free(self, free):
-        if self.contig:
-            self.contigs.append(self.contig)
-            self.contig = None
-        self.off += free.len
-        self.free += free.len
-        if free.len > self.max_free:
-            self.max_free = free.len
-        self.free_extents.append(free)
+        self.new_columns()
+
+    def new_columns(self):
+        self.ext_kind = array('B')
+        self.ext_off = array('Q')
+        self.ext_len = array('Q')
+        self.ext_tree = array('Q')
+        self.ext_ino = array('Q')
+        self.ext_ref_off = array('Q')
+        self.ext_contig = array('I')
+        self.free_off = array('Q')
+        self.free_len = array('Q')
+        self.contig_off = array('Q')
+        self.contig_len = array('Q')
+        self.contig_open = False
+        # the owner keys, as arrays per kind
+        self.owner_arrays = None
+
+    def add_extent(self, kind, off, l, tree, ino, ref_off):
+        if not self.contig_open:
+            self.contig_open = True
+            self.contig_off.append(off)
+            self.contig_len.append(0)
+        self.contig_len[-1] += l
+        self.ext_kind.append(kind)
+        self.ext_off.append(off)
+        self.ext_len.append(l)
+        self.ext_tree.append(tree)
+        self.ext_ino.append(ino)
+        self.ext_ref_off.append(ref_off)
+        self.ext_contig.append(len(self.contig_off) - 1)
+        self.off += l
+
+    def add_shared(self, off, l, ref_off):
+        self.add_extent(SHARED_KIND, off, l, 0, 0, ref_off)
+
+    def add_normal(self, off, l, tree, ino, file_off):
+        self.add_extent(NORMAL_KIND, off, l, tree, ino, file_off)
+
+    def add_metadata(self, off, l, tree, level):
+        self.add_extent(METADATA_KIND, off, l, tree, 0, level)
+
+    def close_contig(self):
+        self.contig_open = False
+
+    def add_free(self, off, l):
+        self.close_contig()
+        self.off += l
+        self.free += l
+        if l > self.max_free:
+            self.max_free = l
+        self.free_off.append(off)
+        self.free_len.append(l)
+
+    # Build the columns of a block group in one pass from its slice of a
+    # record table (see RECORD_COLUMNS), excluding its BG-DONE. off and l are
+    # int64, the ref fields a, b and c stay uint64.
+    def add_records(self, rtype, off, l, a, b, c):
+        is_ext = (rtype <= NORMAL_KIND) | (rtype == METADATA_KIND)
+        is_free = rtype == FREE_KIND
+        self.off += int(l[is_ext | is_free].sum())
+        self.free += int(l[is_free].sum())
+        if is_free.any():
+            self.max_free = max(self.max_free, int(l[is_free].max()))
+        self.free_off = off[is_free]
+        self.free_len = l[is_free]
+
+        # an extent right after a free extent (or first) opens a contig
+        starts = is_ext & ~np.concatenate(([False], is_ext[:-1]))
+        self.ext_contig = (np.cumsum(starts) - 1)[is_ext]
+        self.ext_kind = rtype[is_ext]
+        self.ext_off = off[is_ext]
+        self.ext_len = l[is_ext]
+        shared = self.ext_kind == SHARED_KIND
+        normal = self.ext_kind == NORMAL_KIND
+        meta = self.ext_kind == METADATA_KIND
+        a, b, c = a[is_ext], b[is_ext], c[is_ext]
+        self.ext_tree = np.where(shared, 0, a)
+        self.ext_ino = np.where(normal, b, 0)
+        self.ext_ref_off = np.where(normal, c, np.where(meta, b, a))
+        self.contig_off = off[starts]
+        self.contig_len = np.zeros(0, dtype=np.int64)
+        if len(self.ext_len) > 0:
+            self.contig_len = np.add.reduceat(self.ext_len, np.flatnonzero(starts[is_ext]))
+
+    # Number the owners of the extents and count the distinct ones of each
+    # contig. The owner ids are the ranks of the distinct shared, normal and
+    # tree block owners, whose keys stay in arrays.
+    def compute_owners(self):
+        kind = column(self.ext_kind)
+        contig = column(self.ext_contig)
+        tree = np.asarray(self.ext_tree, dtype=np.uint64)
+        ino = np.asarray(self.ext_ino, dtype=np.uint64)
+        ref_off = np.asarray(self.ext_ref_off, dtype=np.uint64)
+        shared = kind == SHARED_KIND
+        normal = kind == NORMAL_KIND
+        meta = kind == METADATA_KIND
+        shared_keys, shared_inv = np.unique(ref_off[shared], return_inverse=True)
+        normal_keys, normal_inv = unique_pairs(tree[normal], ino[normal])
+        meta_keys, meta_inv = np.unique(tree[meta], return_inverse=True)
+        self.owner_arrays = (shared_keys, normal_keys, meta_keys)
+        nr_owners = len(shared_keys) + len(normal_keys) + len(meta_keys)
+        self.ext_owner = np.empty(len(kind), dtype=np.uint32)
+        self.ext_owner[shared] = shared_inv
+        self.ext_owner[normal] = normal_inv + len(shared_keys)
+        self.ext_owner[meta] = meta_inv + len(shared_keys) + len(normal_keys)
+        pairs = np.unique(contig * max(nr_owners, 1) + self.ext_owner)
+        self.contig_owners = np.bincount(pairs // max(nr_owners, 1), minlength=len(self.contig_off))
+
+    # The kind, a and b columns of the owner keys, by owner id.
+    def owner_columns(self):
+        shared_keys, normal_keys, meta_keys = self.owner_arrays
+        counts = [len(shared_keys), len(normal_keys), len(meta_keys)]
+        kind = np.repeat(np.array([SHARED_KIND, NORMAL_KIND, METADATA_KIND], dtype=np.uint64), counts)
+        a = np.concatenate((shared_keys, normal_keys[:, 0], meta_keys)).astype(np.uint64)
+        b = np.concatenate((np.zeros(len(shared_keys), dtype=np.uint64), normal_keys[:, 1],
+                            np.zeros(len(meta_keys), dtype=np.uint64))).astype(np.uint64)
+        return kind, a, b
 
     def finish(self):
         self.len = self.off
         self.used = self.len - self.free
-        self.num_extents = len(self.extents)
+        self.num_extents = len(self.ext_off)
         self.avg_extent = 0
         if (self.num_extents > 0):
             self.avg_extent = int(self.used / self.num_extents)
-        if self.contig:
-            self.contigs.append(self.contig)
+        self.ext_sketch = LenSketch(column(self.ext_len))
+        self.close_contig()
+        # a block group with tree blocks is a metadata one
+        self.is_metadata = bool((column(self.ext_kind) == METADATA_KIND).any())
+        self.compute_owners()
         self.compute_contig_stats()
         self.compute_free_stats()
 
     def compute_free_stats(self):
         self.avg_free = 0
-        self.num_free = len(self.free_extents)
+        self.num_free = len(self.free_len)
         if (self.num_free > 0):
             self.avg_free = int(self.free / self.num_free)
         self.free_pct = 0
@@ -123,128 +342,1591 @@ class BlockGroup:
         self.frag_pct = 0
         if (self.free > 0):
             self.frag_pct = int(100 * (1 - (self.max_free / self.free)))
-        self.free_lens = sorted([free.len for free in self.free_extents])
+        self.free_lens = column(self.free_len)
         self.free_hist = compute_hist(self.free_lens)
+        self.free_sketch = LenSketch(self.free_lens)
 
     def compute_contig_stats(self):
-        self.num_contigs = len(self.contigs)
-        self.contig_num_owners = [len(contig.owners) for contig in self.contigs]
-        self.contig_lens = sorted([contig.len for contig in self.contigs])
+        self.num_contigs = len(self.contig_off)
+        self.contig_num_owners = column(self.contig_owners)
+        self.contig_lens = column(self.contig_len)
 
         self.avg_contig = 0
         if self.num_contigs > 0:
-            self.avg_contig = int(sum(self.contig_lens) / self.num_contigs)
-            self.avg_contig_owners = int(sum(self.contig_num_owners) / self.num_contigs)
-
-
-        hist = {}
-        contig_cdf = {}
-        contig_pdf = {}
-        contig_cdf_pct = {}
-        contig_pdf_pct = {}
-        step = 4096
-        hist[step] = 0
-        contig_cdf[step] = 0
-        contig_pdf[step] = 0
-        for contig_len in self.contig_lens:
-            while step < contig_len:
-                contig_cdf[step * 2] = contig_cdf[step]
-                step *= 2
-                hist[step] = 0
-                contig_pdf[step] = 0
-            hist[step] += 1
-            contig_cdf[step] += contig_len
-            contig_pdf[step] += contig_len
-        for step, size in contig_cdf.items():
-            contig_cdf_pct[step] = int(100 * (size / self.len))
-        for step, size in contig_pdf.items():
-            contig_pdf_pct[step] = int(100 * (size / self.len))
-        self.contig_hist = hist
-        self.contig_cdf = contig_cdf_pct
-        self.contig_pdf = contig_pdf_pct
+            self.avg_contig = int(int(self.contig_lens.sum()) / self.num_contigs)
+            self.avg_contig_owners = int(int(self.contig_num_owners.sum()) / self.num_contigs)
+
+        buckets = hist_buckets(self.contig_lens)
+        hist = np.bincount(buckets, minlength=1)
+        contig_pdf = np.bincount(buckets, weights=self.contig_lens, minlength=1).astype(np.int64)
+        contig_cdf = np.cumsum(contig_pdf)
+        contig_cdf_pct = np.zeros_like(contig_cdf)
+        contig_pdf_pct = np.zeros_like(contig_pdf)
+        if self.len > 0:
+            contig_cdf_pct = (100 * (contig_cdf / self.len)).astype(np.int64)
+            contig_pdf_pct = (100 * (contig_pdf / self.len)).astype(np.int64)
+        self.contig_sketch = LenSketch(self.contig_lens)
+        self.contig_hist = hist_dict(hist)
+        self.contig_cdf = hist_dict(contig_cdf_pct)
+        self.contig_pdf = hist_dict(contig_pdf_pct)
+
+    # Forget the per-extent state once the stats are computed. Only the
+    # summary numbers and histograms survive.
+    def drop_extents(self):
+        self.new_columns()
+        self.contig_num_owners = []
+        self.contig_lens = []
+        self.free_lens = []
+
+    # The values of BG_FIELDS.
+    def fields(self):
+        return [self.start, self.len, self.free, self.num_free, self.avg_free, self.used, self.num_extents, self.avg_extent, self.num_contigs, self.avg_contig, 100 - self.free_pct, self.free_pct, self.frag_pct]
 
     def __repr__(self):
-        return f'{self.start} {self.len} {self.free} {self.num_free} {self.avg_free} {self.used} {self.num_extents} {self.avg_extent} {self.num_contigs} {self.avg_contig} {100 - self.free_pct} {self.free_pct} {self.frag_pct}'
+        return ' '.join(str(field) for field in self.fields())
 
-class ExtentOwner:
-    def __init__(self, iden):
-        self.id = iden
-        self.bgs = set()
-        self.contigs = set()
-        self.lens = []
+# Bucket 15 (128M) is the largest data extent.
+OWNER_LEN_BUCKETS = 16
 
-    def add_extent(self, extent):
-        self.lens.append(extent.len)
-        self.bgs.add(extent.bg)
-        self.contigs.add(extent.contig)
+OWNER_COLUMNS = ['extents', 'bgs', 'contigs', 'bytes', 'contig_bytes', 'solo_bytes', 'len_hist']
 
-    def num_extents(self):
-        return len(self.lens)
+# Per-owner accumulators, one row per interned owner id: extent count,
+# block group count, contig count, bytes, the total length of the contigs
+# it is in and of those it is alone in, and a log2 histogram of extent
+# lengths for the quantiles. A block group (and so a contig) is never seen
+# twice, so counting the distinct owners of each one is enough. The rows are
+# the ids of the index's own owner table, in the order the owners first
+# appear in the dump.
+class OwnerIndex:
+    def __init__(self):
+        self.table = OwnerIds()
+        self.extents = np.zeros(0, dtype=np.int64)
+        self.bgs = np.zeros(0, dtype=np.int64)
+        self.contigs = np.zeros(0, dtype=np.int64)
+        self.bytes = np.zeros(0, dtype=np.int64)
+        self.contig_bytes = np.zeros(0, dtype=np.int64)
+        self.solo_bytes = np.zeros(0, dtype=np.int64)
+        self.len_hist = np.zeros((0, OWNER_LEN_BUCKETS), dtype=np.uint32)
 
-    def __repr__(self):
-        num_extents = self.num_extents()
-        num_bgs = len(self.bgs)
-        num_contigs = len(self.contigs)
+    def grow(self, n):
+        if n <= len(self.extents):
+            return
+        cap = max(n, 2 * len(self.extents), 1024)
+        for name in OWNER_COLUMNS:
+            old = getattr(self, name)
+            new = np.zeros((cap,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add_bg(self, bg):
+        if bg.num_extents == 0:
+            return
+        ext_len = column(bg.ext_len)
+        bg_ids, first, local, counts = np.unique(column(bg.ext_owner), return_index=True,
+                                                 return_inverse=True, return_counts=True)
+        n = len(bg_ids)
+        kind, a, b = bg.owner_columns()
+        ids = self.table.lookup(kind[bg_ids], a[bg_ids], b[bg_ids], first)
+        self.grow(int(ids.max()) + 1)
+        self.extents[ids] += counts
+        self.bgs[ids] += 1
+        pairs = np.unique(column(bg.ext_contig) * n + local)
+        pair_contig, pair_owner = pairs // n, pairs % n
+        self.contigs[ids] += np.bincount(pair_owner, minlength=n)
+        contig_len = column(bg.contig_len)[pair_contig]
+        solo = column(bg.contig_owners)[pair_contig] == 1
+        self.contig_bytes[ids] += np.bincount(pair_owner, weights=contig_len, minlength=n).astype(np.int64)
+        self.solo_bytes[ids] += np.bincount(pair_owner[solo], weights=contig_len[solo], minlength=n).astype(np.int64)
+        self.bytes[ids] += np.bincount(local, weights=ext_len, minlength=n).astype(np.int64)
+        buckets = np.minimum(hist_buckets(ext_len), OWNER_LEN_BUCKETS - 1)
+        hist = np.bincount(local * OWNER_LEN_BUCKETS + buckets, minlength=n * OWNER_LEN_BUCKETS)
+        self.len_hist[ids] += hist.reshape(n, OWNER_LEN_BUCKETS).astype(np.uint32)
+
+    # The other index's owners are re-interned into this one's table.
+    def merge(self, other):
+        n = len(other.table.keys)
+        if n == 0:
+            return
+        ids = self.table.lookup(*other.table.key_columns(), np.arange(n))
+        self.grow(int(ids.max()) + 1)
+        for name in OWNER_COLUMNS:
+            getattr(self, name)[ids] += getattr(other, name)[:n]
+
+    # Between processes, the table travels as its keys and the unused rows
+    # are left out.
+    def __getstate__(self):
+        n = len(self.table.keys)
+        state = {name: getattr(self, name)[:n] for name in OWNER_COLUMNS}
+        state['keys'] = np.column_stack(self.table.key_columns())
+        return state
+
+    def __setstate__(self, state):
+        keys = state.pop('keys')
+        self.__dict__.update(state)
+        self.table = OwnerIds()
+        self.table.lookup(keys[:, 0], keys[:, 1], keys[:, 2], np.arange(len(keys)))
+
+    # Quartiles of the extent lengths, to the bucket.
+    def len_quartiles(self, iden):
+        cum = np.cumsum(self.len_hist[iden])
+        ranks = [cum[-1] * q / 4 for q in range(1, 4)]
+        return [HIST_MIN << int(np.searchsorted(cum, rank)) for rank in ranks]
+
+    def owner_str(self, iden):
+        num_extents = int(self.extents[iden])
+        num_bgs = int(self.bgs[iden])
+        num_contigs = int(self.contigs[iden])
         bg_count_avg = round(num_extents / num_bgs, 2)
         contig_count_avg = round(num_extents / num_contigs, 2)
-        len_avg = round(sum(self.lens) / num_extents, 2)
-        len_dist = statistics.quantiles(sorted(self.lens), n=4)
-        return f'{self.id} {num_extents} {num_bgs} {bg_count_avg} {num_contigs} {contig_count_avg} {len_avg} {len_dist}'
+        len_avg = round(int(self.bytes[iden]) / num_extents, 2)
+        len_dist = self.len_quartiles(iden)
+        return f'{self.table.name(iden)} {num_extents} {num_bgs} {bg_count_avg} {num_contigs} {contig_count_avg} {len_avg} {len_dist}'
+
+    # The k owners with the most extents, most first. argpartition selects
+    # them in linear time and only those k get sorted.
+    def top(self, k):
+        # Keep every owner tied with the k-th so the cut is made by name.
+        kth = 1
+        if k < len(self.extents):
+            kth = max(kth, np.partition(self.extents, -k)[-k])
+        cand = [int(iden) for iden in np.flatnonzero(self.extents >= kth)]
+        cand.sort(key=lambda iden: (-self.extents[iden], self.table.name(iden)))
+        return cand[:k]
+
+# BTRFS_MAX_EXTENT_SIZE, and the usual data block group size.
+MAX_EXTENT = 128 << 20
+DEFRAG_BG = 1 << 30
+
+# Rank the files, the (tree, ino) owners, as defrag targets. A defrag
+# rewrites a file into as few extents and block groups as its size needs,
+# so the score is the extents it would remove, times how many more block
+# groups the file spans than it needs. It is discounted for files whose
+# extents already sit in long used runs (a mean contig over 1 MiB), where
+# moving them out only punches holes. Shared refs cannot be defragged by
+# path and are left out. The gain is the bytes of the contigs the file is
+# alone in, which become free space and merge with their free neighbours.
+def defrag_targets(index, k):
+    rows = np.flatnonzero(index.extents)
+    rows = rows[np.frombuffer(index.table.kinds, dtype=np.uint8)[rows] == NORMAL_KIND]
+    extents = index.extents[rows]
+    nbytes = index.bytes[rows]
+    mib = nbytes / (1 << 20)
+    ideal_extents = -(-nbytes // MAX_EXTENT)
+    ideal_bgs = -(-nbytes // DEFRAG_BG)
+    mean_contig = index.contig_bytes[rows] / index.contigs[rows]
+    score = ((extents - ideal_extents) * (index.bgs[rows] / ideal_bgs)
+             / np.maximum(mean_contig / (1 << 20), 1))
+    # only the k best scores (and any ties with the kth) are sorted, ties
+    # going to the owner seen first
+    top = np.flatnonzero(score > 0)
+    if len(top) > k:
+        kth = score[top[np.argpartition(-score[top], k - 1)[:k]]].min()
+        top = top[score[top] >= kth]
+    order = top[np.lexsort((rows[top], -score[top]))][:k]
+    targets = []
+    for r in order.tolist():
+        iden = rows[r]
+        targets.append(f'{index.table.name(iden)} {round(score[r], 1)} {extents[r]} {round(mib[r], 2)} '
+                       f'{round(extents[r] / mib[r], 2)} {index.bgs[iden]} {int(mean_contig[r])} '
+                       f'{index.solo_bytes[iden]}')
+    return targets
+
+# The free extents of every block group, in (block group, offset) order,
+# under a max segment tree of their lengths. The max over a block group's
+# range is its max_free, and the leftmost leaf >= size from some position is
+# where a first-fit search starting there ends, so one tree serves both the
+# per block group max-free index and the search inside a block group.
+class FreeSpaceIndex:
+    def __init__(self):
+        self.bg_starts = []
+        self.free_offs = []
+        self.free_lens = []
+
+    def add_bg(self, bg):
+        self.bg_starts.append(bg.start)
+        self.free_offs.append(column(bg.free_off))
+        self.free_lens.append(column(bg.free_len))
+
+    def merge(self, other):
+        self.bg_starts += other.bg_starts
+        self.free_offs += other.free_offs
+        self.free_lens += other.free_lens
+
+    # Index the free extents of every block group but those in skip.
+    def build(self, skip=frozenset()):
+        order = [i for i in np.argsort(self.bg_starts, kind='stable') if self.bg_starts[i] not in skip]
+        self.bgs = [self.bg_starts[i] for i in order]
+        lens = [self.free_lens[i] for i in order]
+        self.bg_first = np.cumsum([0] + [len(l) for l in lens])[:-1].tolist()
+        self.off = np.concatenate([self.free_offs[i] for i in order] + [np.zeros(0, np.int64)]).tolist()
+        lens = np.concatenate(lens + [np.zeros(0, np.int64)])
+        self.leaves = 1 << max(len(lens) - 1, 0).bit_length()
+        tree = np.zeros(2 * self.leaves, dtype=np.int64)
+        tree[self.leaves:self.leaves + len(lens)] = lens
+        for level in range(self.leaves.bit_length() - 1, 0, -1):
+            lo = 1 << (level - 1)
+            tree[lo:2 * lo] = np.maximum(tree[2 * lo:4 * lo:2], tree[2 * lo + 1:4 * lo:2])
+        self.tree = tree.tolist()
+
+    def max_free(self):
+        return self.tree[1]
+
+    def free_len(self, i):
+        return self.tree[self.leaves + i]
+
+    def bg_index(self, i):
+        return bisect.bisect_right(self.bg_first, i) - 1
+
+    # The leftmost free extent at or after i with at least size bytes, or None.
+    def find(self, i, size):
+        tree = self.tree
+        node = i + self.leaves
+        while tree[node] < size:
+            while node & 1:
+                node >>= 1
+            if node == 0:
+                return None
+            node += 1
+        while node < self.leaves:
+            node <<= 1
+            if tree[node] < size:
+                node += 1
+        return node - self.leaves
+
+    # Allocate size bytes from the front of free extent i.
+    def take(self, i, size):
+        tree = self.tree
+        self.off[i] += size
+        node = i + self.leaves
+        tree[node] -= size
+        node >>= 1
+        while node:
+            m = max(tree[2 * node], tree[2 * node + 1])
+            if tree[node] == m:
+                break
+            tree[node] = m
+            node >>= 1
+
+    def remaining_lens(self):
+        return np.array(self.tree[self.leaves:self.leaves + len(self.off)], dtype=np.int64)
+
+ALLOC_POLICIES = ['first-fit', 'clustered']
+
+# Replay allocations of the given sizes against the free space, like
+# find_free_extent on data block groups in logical order. first-fit starts
+# every search at the first block group. clustered starts where the last
+# allocation was made and wraps around, so it keeps filling one block group
+# before moving on. Yields (size, searched, extent) per allocation, where
+# searched is the number of block groups looked at and extent is None on
+# failure.
+def replay_allocs(index, sizes, policy):
+    bg_index = index.bg_index
+    find = index.find
+    take = index.take
+    nr_bgs = len(index.bgs)
+    hint = hint_bg = 0
+    for size in sizes:
+        i = find(hint, size)
+        if i is None and hint > 0:
+            i = find(0, size)
+        if i is None:
+            yield size, nr_bgs, None
+            continue
+        found_bg = bg_index(i)
+        take(i, size)
+        yield size, (found_bg - hint_bg) % nr_bgs + 1, i
+        if policy == 'clustered':
+            hint, hint_bg = i, found_bg
+
+def report_allocs(index, args):
+    sizes = np.fromstring(open(args.alloc).read(), dtype=np.int64, sep=' ')
+    sizes = -(-sizes[sizes > 0] // HIST_MIN) * HIST_MIN
+    index.build()
+    searched_all = np.zeros(len(sizes), dtype=np.int64)
+    nr_failed = 0
+    window = args.alloc_window or len(sizes)
+    win_searched = win_max = win_failed = 0
+    t = time.perf_counter()
+    for n, (size, searched, i) in enumerate(replay_allocs(index, sizes.tolist(), args.alloc_policy)):
+        searched_all[n] = searched
+        if i is None:
+            nr_failed += 1
+            win_failed += 1
+            print(f'fail {n} {size} {index.max_free()}')
+        win_searched += searched
+        win_max = max(win_max, searched)
+        if args.alloc_window and (n + 1) % window == 0:
+            print(f'window {n + 1 - window} {window} {round(win_searched / window, 2)} {win_max} {win_failed} {index.max_free()}')
+            win_searched = win_max = win_failed = 0
+    elapsed = time.perf_counter() - t
+    print(f'alloc {args.alloc_policy} {len(sizes)} {len(sizes) - nr_failed} {nr_failed} '
+          f'{int(sizes.sum())} searched {LenSketch(searched_all)}')
+    free_lens = index.remaining_lens()
+    print(compute_hist(free_lens[free_lens > 0]))
+    print(f'{len(sizes)} allocations in {elapsed:.2f}s', file=sys.stderr)
+
+# The offsets and lengths of the extents of a block group in offset order,
+# with the refs of one extent counted once, which bg.len does not do.
+def unique_extents(bg):
+    off = column(bg.ext_off)
+    order = np.argsort(off, kind='stable')
+    off, l = off[order], column(bg.ext_len)[order]
+    first = np.ones(len(off), dtype=bool)
+    first[1:] = off[1:] != off[:-1]
+    return off[first], l[first]
+
+# The bytes from the start of a block group to the end of its last extent or
+# free extent, its length as far as the dump shows.
+def bg_span(bg, off, l):
+    free_end = column(bg.free_off) + column(bg.free_len)
+    return max([bg.start] + [int(e.max()) for e in (off + l, free_end) if len(e)]) - bg.start
+
+# Extents alternate through these, as in rust/btrfs-frag-view, so that
+# neighbours can be told apart. Free space is white.
+RASTER_COLORS = np.array([[255, 0, 0], [0, 255, 0], [0, 0, 255]], dtype=np.float64)
+RASTER_FREE = np.array([255, 255, 255], dtype=np.float64)
+RASTER_GUTTER = 128
+
+# Paint a block group into a side x side RGB tile, row by row from its
+# start, in one vectorized pass. Each pixel covers len / side^2 bytes and is
+# shaded by the fraction of them in extents, which is the difference of the
+# used bytes below its two edges. The used bytes below x come from the
+# cumulative extent lengths: all the extents that end by x, plus the part of
+# the next one before x.
+def raster_bg(bg, side):
+    off, l = unique_extents(bg)
+    end = off + l
+    span = bg_span(bg, off, l)
+    nr_pixels = side * side
+    edges = bg.start + np.arange(nr_pixels + 1, dtype=np.int64) * span // nr_pixels
+    cum = np.concatenate(([0], np.cumsum(l)))
+    pad_off = np.append(off, np.iinfo(np.int64).max)
+    pad_len = np.append(l, 0)
+    k = np.searchsorted(end, edges, side='right')
+    used_below = cum[k] + np.clip(edges - pad_off[k], 0, pad_len[k])
+    width = np.maximum(np.diff(edges), 1)
+    occupied = (np.diff(used_below) / width)[:, None]
+    middle = edges[:-1] + width // 2
+    color = RASTER_COLORS[np.maximum(np.searchsorted(off, middle, side='right') - 1, 0) % len(RASTER_COLORS)]
+    pixels = RASTER_FREE * (1 - occupied) + color * occupied
+    return np.rint(pixels).astype(np.uint8).reshape(side, side, 3)
+
+def save_png(path, pixels):
+    from matplotlib.image import imsave
+    imsave(path, pixels)
+
+# Lay the tiles out in a near square grid with a one pixel gutter.
+def raster_atlas(tiles, side):
+    n = len(tiles)
+    cols = max(int(np.ceil(np.sqrt(n))), 1)
+    rows = max(-(-n // cols), 1)
+    grid = np.full((rows * cols, side + 1, side + 1, 3), RASTER_GUTTER, dtype=np.uint8)
+    if n:
+        grid[:n, 1:, 1:] = np.stack(tiles)
+    atlas = grid.reshape(rows, cols, side + 1, side + 1, 3).transpose(0, 2, 1, 3, 4)
+    atlas = atlas.reshape(rows * (side + 1), cols * (side + 1), 3)
+    return np.pad(atlas, ((0, 1), (0, 1), (0, 0)), constant_values=RASTER_GUTTER)
+
+# Rasterize each finished block group. Into a directory, every block group
+# is written as <start>.png right away, from whichever process finished it.
+# Into a .png path, the tiles are kept, merged across processes, and written
+# as one atlas in block group order at the end.
+class Rasterizer:
+    def __init__(self, path, side):
+        self.path = path
+        self.side = side
+        self.atlas = path.endswith('.png')
+        self.starts = []
+        self.tiles = []
+        if not self.atlas:
+            os.makedirs(path, exist_ok=True)
+
+    def add_bg(self, bg):
+        tile = raster_bg(bg, self.side)
+        if self.atlas:
+            self.starts.append(bg.start)
+            self.tiles.append(tile)
+        else:
+            save_png(os.path.join(self.path, f'{bg.start}.png'), tile)
+
+    def merge(self, other):
+        self.starts += other.starts
+        self.tiles += other.tiles
+
+    def close(self):
+        if not self.atlas:
+            return
+        order = np.argsort(self.starts, kind='stable')
+        save_png(self.path, raster_atlas([self.tiles[i] for i in order], self.side))
+
+# Past this many cells of the knapsack table, plan_relocation() is greedy.
+KNAPSACK_CELLS = 1 << 26
+
+# What relocating each block group would cost and free: its span comes back
+# as unallocated space, and its extents, each ref counted once, have to be
+# written into the free space of the others.
+class RelocPlanner:
+    def __init__(self):
+        self.starts = []
+        self.spans = []
+        self.moved = []
+        self.extents = []
+        self.ext_lens = []
+        self.free_space = FreeSpaceIndex()
+
+    def add_bg(self, bg):
+        off, l = unique_extents(bg)
+        self.starts.append(bg.start)
+        self.spans.append(bg_span(bg, off, l))
+        self.moved.append(int(l.sum()))
+        self.extents.append(len(l))
+        self.ext_lens.append(l)
+        self.free_space.add_bg(bg)
+
+    def merge(self, other):
+        self.starts += other.starts
+        self.spans += other.spans
+        self.moved += other.moved
+        self.extents += other.extents
+        self.ext_lens += other.ext_lens
+        self.free_space.merge(other.free_space)
+
+    def sort(self):
+        order = np.argsort(self.starts, kind='stable')
+        for name in ['starts', 'spans', 'moved', 'extents', 'ext_lens']:
+            vals = getattr(self, name)
+            setattr(self, name, [vals[i] for i in order])
+
+    # Replay the extents of the picked block groups, in order, first-fit into
+    # the free space of the rest. What does not fit would need new chunks.
+    def spill(self, picked):
+        self.free_space.build(skip={self.starts[i] for i in picked})
+        sizes = [l for i in picked for l in self.ext_lens[i].tolist()]
+        return sum(size for size, _, extent in replay_allocs(self.free_space, sizes, 'first-fit')
+                   if extent is None)
+
+    def plan_str(self, name, picked):
+        freed = sum(self.spans[i] for i in picked)
+        moved = sum(self.moved[i] for i in picked)
+        extents = sum(self.extents[i] for i in picked)
+        return f'{name} {len(picked)} {freed} {moved} {extents} {self.spill(picked)}'
+
+# Pick the block groups to relocate that free at least target bytes for the
+# least bytes moved plus extent_cost per extent. This is a min-cost cover
+# knapsack over the spans in units of their gcd, solved exactly when the
+# table is small enough. Otherwise, and with block groups all of one size it
+# makes no difference, the cheapest per byte freed are taken first.
+def plan_relocation(planner, target, extent_cost):
+    spans = np.array(planner.spans, dtype=np.int64)
+    cost = np.array(planner.moved, dtype=np.float64) + extent_cost * np.array(planner.extents)
+    n = len(spans)
+    if n == 0 or target <= 0:
+        return [], 'empty'
+    if spans.sum() < target:
+        return list(range(n)), 'all'
+    unit = max(int(np.gcd.reduce(spans)), 1)
+    units = -(-target // unit)
+    weights = spans // unit
+    if n * (units + 1) > KNAPSACK_CELLS:
+        picked = []
+        freed = 0
+        for i in np.argsort(cost / np.maximum(spans, 1), kind='stable'):
+            if freed >= target:
+                break
+            picked.append(int(i))
+            freed += int(spans[i])
+        return sorted(picked), 'greedy'
+    best = np.full(units + 1, np.inf)
+    best[0] = 0
+    took = np.zeros((n, units + 1), dtype=bool)
+    need = np.arange(units + 1)
+    for i in range(n):
+        with_i = best[np.maximum(need - weights[i], 0)] + cost[i]
+        took[i] = with_i < best
+        best = np.where(took[i], with_i, best)
+    picked = []
+    j = units
+    for i in range(n - 1, -1, -1):
+        if took[i, j]:
+            picked.append(i)
+            j = max(j - int(weights[i]), 0)
+    return sorted(picked), 'knapsack'
+
+def report_reloc(planner, args):
+    planner.sort()
+    used_pct = [100 * moved / max(span, 1) for moved, span in zip(planner.moved, planner.spans)]
+    picked, method = plan_relocation(planner, args.reloc, args.reloc_extent_cost)
+    for i in picked:
+        print(f'reloc {planner.starts[i]} {int(used_pct[i])} {planner.moved[i]} {planner.extents[i]}')
+    print(planner.plan_str(f'plan {method}', picked))
+    # bg_reclaim_threshold relocates every block group used below it
+    thresh = [i for i, pct in enumerate(used_pct) if pct < args.reloc_thresh]
+    print(planner.plan_str(f'thresh {args.reloc_thresh}', thresh))
+    # and the lowest threshold that frees the target
+    freed = 0
+    for i in sorted(range(len(used_pct)), key=lambda i: used_pct[i]):
+        freed += planner.spans[i]
+        if freed >= args.reloc:
+            print(f'thresh-needed {int(used_pct[i]) + 1}')
+            break
+
+# The data size classes of the kernel: small below 128K, medium below 8M.
+SIZE_CLASS_BOUNDS = '128K,8M'
+
+def size_str(val):
+    for suffix in ['T', 'G', 'M', 'K']:
+        if val >= SIZE_SUFFIXES[suffix] and val % SIZE_SUFFIXES[suffix] == 0:
+            return f'{val // SIZE_SUFFIXES[suffix]}{suffix}'
+    return f'{val}'
+
+# How well the extents of each block group are separated by size class. A
+# block group belongs to the class that holds most of its used bytes, and
+# its purity is that share. Its free space serves that class, so per class
+# the free space of its block groups is summarized by how fragmented it is
+# (as frag_pct) and by how much of it is in free extents below the class,
+# too small for it. An extent is trapped when the extents before and after
+# it are both of a larger class: it pins a hole once they are freed.
+class SizeClasses:
+    def __init__(self, bounds):
+        self.bounds = np.array(bounds, dtype=np.int64)
+        k = len(bounds) + 1
+        self.names = [f'<{size_str(b)}' for b in bounds] + [f'>={size_str(bounds[-1])}']
+        self.bg_rows = []
+        self.extents = np.zeros(k, dtype=np.int64)
+        self.bytes = np.zeros(k, dtype=np.int64)
+        self.trapped = np.zeros(k, dtype=np.int64)
+        self.trapped_bytes = np.zeros(k, dtype=np.int64)
+        self.bgs = np.zeros(k, dtype=np.int64)
+        self.free = np.zeros(k, dtype=np.int64)
+        self.free_frag = np.zeros(k, dtype=np.int64)
+        self.unusable = np.zeros(k, dtype=np.int64)
+
+    def add_bg(self, bg):
+        k = len(self.names)
+        _, l = unique_extents(bg)
+        cls = np.searchsorted(self.bounds, l, side='right')
+        counts = np.bincount(cls, minlength=k)
+        nbytes = np.bincount(cls, weights=l, minlength=k).astype(np.int64)
+        self.extents += counts
+        self.bytes += nbytes
+        mid = cls[1:-1]
+        trapped = (cls[:-2] > mid) & (cls[2:] > mid)
+        self.trapped += np.bincount(mid[trapped], minlength=k)
+        self.trapped_bytes += np.bincount(mid[trapped], weights=l[1:-1][trapped], minlength=k).astype(np.int64)
+        if len(l) == 0:
+            return
+        dominant = int(np.argmax(nbytes))
+        self.bg_rows.append((bg.start, dominant, int(100 * nbytes[dominant] / nbytes.sum()), counts.tolist()))
+        free_len = column(bg.free_len)
+        free_cls = np.searchsorted(self.bounds, free_len, side='right')
+        self.bgs[dominant] += 1
+        self.free[dominant] += int(free_len.sum())
+        self.free_frag[dominant] += int(free_len.sum()) - bg.max_free
+        self.unusable[dominant] += int(free_len[free_cls < dominant].sum())
+
+    def merge(self, other):
+        self.bg_rows += other.bg_rows
+        for name in ['extents', 'bytes', 'trapped', 'trapped_bytes', 'bgs', 'free', 'free_frag', 'unusable']:
+            getattr(self, name)[:] += getattr(other, name)
+
+def pct(part, whole):
+    return int(100 * part / whole) if whole else 0
+
+def report_size_classes(classes):
+    for start, dominant, purity, counts in sorted(classes.bg_rows):
+        print(f"sizeclass {start} {classes.names[dominant]} {purity} {' '.join(map(str, counts))}")
+    for c, name in enumerate(classes.names):
+        print(f'class {name} extents {classes.extents[c]} bytes {classes.bytes[c]} bgs {classes.bgs[c]} '
+              f'free {classes.free[c]} frag {pct(classes.free_frag[c], classes.free[c])} '
+              f'unusable {pct(classes.unusable[c], classes.free[c])} '
+              f'trapped {classes.trapped[c]} {classes.trapped_bytes[c]}')
+    pure = sum(1 for row in classes.bg_rows if row[2] == 100)
+    print(f'pure {pure} of {len(classes.bg_rows)} trapped {int(classes.trapped.sum())} of {int(classes.extents.sum())}')
 
-def process_frag_line(bgs, line):
+# BTRFS_MAX_LEVEL
+META_LEVELS = 8
+META_COLUMNS = ['nodes', 'bytes', 'bgs', 'runs']
+
+# The tree blocks of the block groups that have METADATA-ITEM records. Per
+# block group: its tree blocks, the share of its length they take and the
+# number of trees they belong to. Per tree: its tree blocks, bytes, block
+# groups, tree blocks per level and runs, a run being tree blocks of the
+# tree back to back with no free space or other tree's block in between. A
+# tree spread over many block groups in runs of about one block is the
+# scattered kind, whose COW leaves holes everywhere and which every
+# relocation of those block groups has to move.
+class MetadataIndex:
+    def __init__(self):
+        self.bg_rows = []
+        self.trees = {}
+
+    def add_bg(self, bg):
+        meta = np.asarray(bg.ext_kind) == METADATA_KIND
+        if not meta.any():
+            return
+        off = column(bg.ext_off)[meta]
+        l = column(bg.ext_len)[meta]
+        tree = np.asarray(bg.ext_tree, dtype=np.uint64)[meta]
+        level = np.minimum(column(bg.ext_ref_off)[meta], META_LEVELS - 1)
+        order = np.argsort(off, kind='stable')
+        off, l, tree, level = off[order], l[order], tree[order], level[order]
+        run_start = np.ones(len(off), dtype=bool)
+        run_start[1:] = (tree[1:] != tree[:-1]) | (off[1:] != off[:-1] + l[:-1])
+        trees, inv = np.unique(tree, return_inverse=True)
+        n = len(trees)
+        rows = np.zeros((n, len(META_COLUMNS) + META_LEVELS), dtype=np.int64)
+        rows[:, 0] = np.bincount(inv, minlength=n)
+        rows[:, 1] = np.bincount(inv, weights=l, minlength=n)
+        rows[:, 2] = 1
+        rows[:, 3] = np.bincount(inv[run_start], minlength=n)
+        rows[:, len(META_COLUMNS):] = np.bincount(inv * META_LEVELS + level,
+                                                  minlength=n * META_LEVELS).reshape(n, META_LEVELS)
+        for t, row in zip(trees.tolist(), rows):
+            acc = self.trees.get(t)
+            if acc is None:
+                self.trees[t] = row
+            else:
+                acc += row
+        span = bg_span(bg, *unique_extents(bg))
+        self.bg_rows.append((bg.start, len(off), int(l.sum()), pct(int(l.sum()), span), bg.frag_pct, n))
+
+    def merge(self, other):
+        self.bg_rows += other.bg_rows
+        for t, row in other.trees.items():
+            acc = self.trees.get(t)
+            if acc is None:
+                self.trees[t] = row
+            else:
+                acc += row
+
+def report_metadata(index):
+    for start, nodes, nbytes, used_pct, frag_pct, nr_trees in sorted(index.bg_rows):
+        print(f'metabg {start} {nodes} {nbytes} {used_pct} {frag_pct} {nr_trees}')
+    # most scattered first: the fewest tree blocks per run
+    order = sorted(index.trees.items(), key=lambda tr: (tr[1][0] / tr[1][3], -tr[1][2], tr[0]))
+    for tree, row in order:
+        nodes, nbytes, bgs, runs = row[:len(META_COLUMNS)].tolist()
+        levels = row[len(META_COLUMNS):].tolist()
+        while len(levels) > 1 and levels[-1] == 0:
+            levels.pop()
+        print(f'tree {tree} nodes {nodes} bytes {nbytes} bgs {bgs} runs {runs} '
+              f'{round(nodes / runs, 2)} levels {levels}')
+    nodes = sum(row[1] for row in index.bg_rows)
+    runs = sum(int(row[3]) for row in index.trees.values())
+    print(f'metadata {len(index.bg_rows)} bgs {nodes} nodes {len(index.trees)} trees {runs} runs')
+
+def merge_hist(hist, other):
+    for step, count in other.items():
+        hist[step] = hist.get(step, 0) + count
+
+# Filesystem-wide totals over finished block groups. Summaries of disjoint
+# sets of block groups merge, so each worker of a sharded run keeps its own.
+class FragSummary:
+    def __init__(self, name='total'):
+        self.name = name
+        self.num_bgs = 0
+        self.len = 0
+        self.free = 0
+        self.used = 0
+        self.num_free = 0
+        self.num_extents = 0
+        self.num_contigs = 0
+        self.max_free = 0
+        self.free_hist = {}
+        self.contig_hist = {}
+        self.free_sketch = LenSketch()
+        self.contig_sketch = LenSketch()
+        self.ext_sketch = LenSketch()
+
+    def add_bg(self, bg):
+        self.num_bgs += 1
+        self.len += bg.len
+        self.free += bg.free
+        self.used += bg.used
+        self.num_free += bg.num_free
+        self.num_extents += bg.num_extents
+        self.num_contigs += bg.num_contigs
+        self.max_free = max(self.max_free, bg.max_free)
+        merge_hist(self.free_hist, bg.free_hist)
+        merge_hist(self.contig_hist, bg.contig_hist)
+        self.free_sketch.merge(bg.free_sketch)
+        self.contig_sketch.merge(bg.contig_sketch)
+        self.ext_sketch.merge(bg.ext_sketch)
+
+    def merge(self, other):
+        self.num_bgs += other.num_bgs
+        self.len += other.len
+        self.free += other.free
+        self.used += other.used
+        self.num_free += other.num_free
+        self.num_extents += other.num_extents
+        self.num_contigs += other.num_contigs
+        self.max_free = max(self.max_free, other.max_free)
+        merge_hist(self.free_hist, other.free_hist)
+        merge_hist(self.contig_hist, other.contig_hist)
+        self.free_sketch.merge(other.free_sketch)
+        self.contig_sketch.merge(other.contig_sketch)
+        self.ext_sketch.merge(other.ext_sketch)
+
+    def __repr__(self):
+        avg_free = int(self.free / self.num_free) if self.num_free else 0
+        avg_extent = int(self.used / self.num_extents) if self.num_extents else 0
+        avg_contig = int(self.used / self.num_contigs) if self.num_contigs else 0
+        free_pct = int(100 * self.free / self.len) if self.len else 0
+        frag_pct = int(100 * (1 - (self.max_free / self.free))) if self.free else 0
+        return f'{self.name} {self.num_bgs} {self.len} {self.free} {self.num_free} {avg_free} {self.used} {self.num_extents} {avg_extent} {self.num_contigs} {avg_contig} {100 - free_pct} {free_pct} {frag_pct}'
+
+# Everything accumulated over the finished block groups of a run. Workers of
+# a sharded run build one each and the parent merges them. Metadata block
+# groups only go to their own totals, the metadata index and the raster,
+# the rest is about data block groups.
+class Analysis:
+    def __init__(self, args):
+        self.total = FragSummary()
+        self.meta_total = FragSummary('metatotal')
+        self.owners = OwnerIndex() if args.owners or args.defrag else None
+        self.free_space = FreeSpaceIndex() if args.alloc else None
+        self.raster = Rasterizer(args.raster, args.raster_size) if args.raster else None
+        self.reloc = RelocPlanner() if args.reloc else None
+        self.size_classes = SizeClasses(args.class_bounds) if args.size_classes else None
+        self.metadata = MetadataIndex() if args.metadata else None
+
+    def add_bg(self, bg):
+        if self.raster is not None:
+            self.raster.add_bg(bg)
+        if bg.is_metadata:
+            self.meta_total.add_bg(bg)
+            if self.metadata is not None:
+                self.metadata.add_bg(bg)
+            return
+        self.total.add_bg(bg)
+        if self.owners is not None:
+            self.owners.add_bg(bg)
+        if self.free_space is not None:
+            self.free_space.add_bg(bg)
+        if self.reloc is not None:
+            self.reloc.add_bg(bg)
+        if self.size_classes is not None:
+            self.size_classes.add_bg(bg)
+
+    def merge(self, other):
+        self.total.merge(other.total)
+        self.meta_total.merge(other.meta_total)
+        if self.owners is not None:
+            self.owners.merge(other.owners)
+        if self.free_space is not None:
+            self.free_space.merge(other.free_space)
+        if self.raster is not None:
+            self.raster.merge(other.raster)
+        if self.reloc is not None:
+            self.reloc.merge(other.reloc)
+        if self.size_classes is not None:
+            self.size_classes.merge(other.size_classes)
+        if self.metadata is not None:
+            self.metadata.merge(other.metadata)
+
+def report_analysis(analysis, args):
+    if args.summary:
+        print(analysis.total)
+        print(analysis.total.free_hist)
+        print(f'free {analysis.total.free_sketch}')
+        print(f'contig {analysis.total.contig_sketch}')
+        print(f'extent {analysis.total.ext_sketch}')
+        if analysis.meta_total.num_bgs:
+            print(analysis.meta_total)
+    if args.owners:
+        for iden in analysis.owners.top(args.owners):
+            print(analysis.owners.owner_str(iden))
+    if args.defrag:
+        for target in defrag_targets(analysis.owners, args.defrag):
+            print(target)
+    if analysis.free_space is not None:
+        report_allocs(analysis.free_space, args)
+    if analysis.raster is not None:
+        analysis.raster.close()
+    if analysis.reloc is not None:
+        report_reloc(analysis.reloc, args)
+    if analysis.size_classes is not None:
+        report_size_classes(analysis.size_classes)
+    if analysis.metadata is not None:
+        report_metadata(analysis.metadata)
+
+# The binary form of a dump: one row per record, stored as one column per
+# field. a, b and c are ref_off for a shared extent, tree, ino and
+# file_off for a resolved one and tree and level for a tree block.
+RECORD_TYPES = {SHARED_EXTENT: SHARED_KIND, NORMAL_EXTENT: NORMAL_KIND, FREE: FREE_KIND, BG_DONE: BG_DONE_KIND,
+                METADATA_ITEM: METADATA_KIND}
+RECORD_COLUMNS = ['type', 'bg', 'off', 'len', 'a', 'b', 'c']
+RECORD_DTYPES = {'type': np.uint8, 'bg': np.uint64, 'off': np.uint64, 'len': np.uint64,
+                 'a': np.uint64, 'b': np.uint64, 'c': np.uint64}
+RECORD_CHUNK = 1 << 20
+
+# Yield the records of a dump as dicts of record columns, RECORD_CHUNK rows
+# at a time. Lines that are not bg-frag records are skipped.
+def tokenize_frag_lines(lines):
+    cols = {name: array('B' if name == 'type' else 'Q') for name in RECORD_COLUMNS}
+    for line in lines:
+        toks = line.split()
+        if not toks or toks[0] not in RECORD_TYPES:
+            continue
+        vals = [int(tok) for tok in toks[1:7]]
+        vals += [0] * (6 - len(vals))
+        cols['type'].append(RECORD_TYPES[toks[0]])
+        for name, val in zip(RECORD_COLUMNS[1:], vals):
+            cols[name].append(val)
+        if len(cols['type']) == RECORD_CHUNK:
+            yield {name: np.asarray(col) for name, col in cols.items()}
+            cols = {name: array(col.typecode) for name, col in cols.items()}
+    if len(cols['type']) > 0:
+        yield {name: np.asarray(col) for name, col in cols.items()}
+
+# The bulk tokenizer reads BULK_BLOCK bytes at a time. It tells the record
+# types apart by the first 8 bytes of each line and checks the rest of the
+# type name 8 bytes at a time. Blocks in the single spaced form
+# bg-frag.btrd prints, where the only bytes besides the names are digits,
+# blanks and newlines and each line has as many blanks as its type has
+# fields, then get every number parsed with one np.fromstring() and
+# scattered into the record columns.
+# The intermediates of a block take about 20 times its size, and larger
+# blocks are no faster.
+BULK_BLOCK = 4 << 20
+RECORD_WIDTHS = np.array([4, 6, 3, 3, 5])
+NUMBER_CHARS = b"0123456789 \n"
+DIGITS_ONLY = bytes(c if c in b"0123456789\n" else ord(' ') for c in range(256))
+# what np.fromstring() saturates numbers that do not fit in 64 bits to
+UINT64_MAX = np.uint64((1 << 64) - 1)
+
+# Each type name and the blank after it as little endian words, with the
+# masks of their bytes.
+NAME_WORDS = 3
+def name_words(name):
+    tok = f"{name} ".encode()
+    words = [int.from_bytes(tok[i:i + 8].ljust(8, b'\0'), 'little') for i in range(0, 8 * NAME_WORDS, 8)]
+    masks = [int.from_bytes(b'\xff' * len(tok[i:i + 8]) + b'\0' * (8 - len(tok[i:i + 8])), 'little')
+             for i in range(0, 8 * NAME_WORDS, 8)]
+    return words, masks
+
+TYPE_NAMES = sorted(RECORD_TYPES, key=RECORD_TYPES.get)
+TYPE_WORDS = np.array([name_words(name)[0] for name in TYPE_NAMES], dtype=np.uint64)
+TYPE_MASKS = np.array([name_words(name)[1] for name in TYPE_NAMES], dtype=np.uint64)
+TYPE_NAME_LENS = np.array([len(name) for name in TYPE_NAMES])
+
+# Record columns of a block of whole lines, or None if any line of it is
+# not a well formed record.
+def tokenize_frag_block(buf):
+    padded = buf + b'\0' * (8 * NAME_WORDS)
+    arr = np.frombuffer(padded, dtype=np.uint8)
+    # the 8 bytes from every offset, unaligned
+    words = np.ndarray(len(buf) + 8 * (NAME_WORDS - 1), dtype='<u8', buffer=padded, strides=(1,))
+    starts = np.concatenate(([0], np.flatnonzero(arr[:len(buf) - 1] == ord('\n')) + 1))
+    word = words[starts]
+    rtype = np.full(len(starts), 255, dtype=np.uint8)
+    for code in range(len(TYPE_NAMES)):
+        rtype[(word & TYPE_MASKS[code, 0]) == TYPE_WORDS[code, 0]] = code
+    if np.any(rtype == 255):
+        return None
+    for i in range(1, NAME_WORDS):
+        if np.any((words[starts + 8 * i] & TYPE_MASKS[rtype, i]) != TYPE_WORDS[rtype, i]):
+            return None
+    if len(buf.translate(None, NUMBER_CHARS)) != int(TYPE_NAME_LENS[rtype].sum()):
+        return None
+    # no blank is followed by another one or a newline
+    blanks = np.flatnonzero(arr[:len(buf)] == ord(' '))
+    if np.any(arr[blanks + 1] < ord('0')):
+        return None
+    widths = RECORD_WIDTHS[rtype]
+    if np.any(np.diff(np.searchsorted(blanks, np.append(starts, len(buf)))) != widths):
+        return None
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        try:
+            flat = np.fromstring(buf.translate(DIGITS_ONLY), dtype=np.uint64, sep=' ')
+        except (ValueError, DeprecationWarning):
+            return None
+    if len(flat) != widths.sum() or np.any(flat == UINT64_MAX):
+        return None
+    first = np.cumsum(widths) - widths
+    cols = {'type': rtype}
+    for j, name in enumerate(RECORD_COLUMNS[1:]):
+        has = widths > j
+        cols[name] = np.zeros(len(rtype), dtype=np.uint64)
+        cols[name][has] = flat[first[has] + j]
+    return cols
+
+# Yield blocks of whole lines from the byte range [start, end) of f.
+def read_blocks(f, start=0, end=None):
+    if start:
+        f.seek(start)
+    pos = start
+    carry = b''
+    while True:
+        n = BULK_BLOCK if end is None else min(BULK_BLOCK, end - pos)
+        data = f.read(n) if n > 0 else b''
+        pos += len(data)
+        if not data:
+            if carry:
+                yield carry + b'\n'
+            return
+        buf = carry + data
+        cut = buf.rfind(b'\n') + 1
+        carry = buf[cut:]
+        if cut:
+            yield buf[:cut]
+
+# Same chunks as tokenize_frag_lines(), from a binary file. Blocks with
+# anything but records in them go through tokenize_frag_lines().
+def tokenize_frag_bulk(f, start=0, end=None):
+    for block in read_blocks(f, start, end):
+        cols = tokenize_frag_block(block)
+        if cols is None:
+            yield from tokenize_frag_lines(block.decode().splitlines())
+        elif len(cols['type']) > 0:
+            yield cols
+
+def concat_records(a, b):
+    if a is None:
+        return b
+    return {name: np.concatenate((a[name], b[name])) for name in RECORD_COLUMNS}
+
+def slice_records(recs, lo, hi):
+    return {name: recs[name][lo:hi] for name in RECORD_COLUMNS}
+
+# Stream the finished block groups of a binary file through the bulk
+# tokenizer. Records after the last BG-DONE of a chunk carry over to the
+# next one; once block groups interleave, bgs holds the open ones. Those
+# still open at the end are left in bgs if given.
+def stream_frag_bulk(f, start=0, end=None, bgs=None):
+    final = bgs is None
+    if final:
+        bgs = {}
+    carry = None
+    for chunk in tokenize_frag_bulk(f, start, end):
+        recs = concat_records(carry, chunk)
+        n = len(recs['type'])
+        if bgs:
+            yield from stream_frag_records(iter_records(recs, 0, n), bgs, final=False)
+            carry = None
+            continue
+        dones = record_dones(recs, 0, n)
+        hi = int(dones[-1]) + 1 if len(dones) else 0
+        yield from frag_records_bgs(recs, 0, hi, bgs=bgs)
+        carry = slice_records(recs, hi, n)
+    if carry is None:
+        carry = {name: np.zeros(0, dtype=RECORD_DTYPES[name]) for name in RECORD_COLUMNS}
+    yield from stream_frag_records(iter_records(carry, 0, len(carry['type'])), bgs, final=final)
+
+def parse_frag_line(line):
     cols = line.split()
-    line_type = cols[0]
+    rtype = RECORD_TYPES.get(cols[0])
     bg_start = int(cols[1])
     off = int(cols[2])
     l = int(cols[3])
+    a = b = c = 0
+    if rtype == SHARED_KIND:
+        a = int(cols[4])
+    elif rtype == NORMAL_KIND:
+        a = int(cols[4])
+        b = int(cols[5])
+        c = int(cols[6])
+    elif rtype == METADATA_KIND:
+        a = int(cols[4])
+        b = int(cols[5])
+    return rtype, bg_start, off, l, a, b, c
 
-    if bg_start not in bgs:
-        bgs[bg_start] = BlockGroup(bg_start)
-    bg = bgs[bg_start]
-    last_bg = bg
-
-    if (line_type == SHARED_EXTENT):
-        ref_off = int(cols[4])
-        bg.add_shared(SharedExtent(bg_start, off, l, ref_off))
-    elif (line_type == NORMAL_EXTENT):
-        tree = int(cols[4])
-        ino = int(cols[5])
-        file_off = int(cols[6])
-        bg.add_normal(NormalExtent(bg_start, off, l, tree, ino, file_off))
-    elif (line_type == FREE):
-        bg.add_free(FreeExtent(bg_start, off, l))
-    elif (line_type == BG_DONE):
+def process_frag_record(bgs, rtype, bg_start, off, l, a, b, c):
+    bg = bgs.get(bg_start)
+    if bg is None:
+        bg = bgs[bg_start] = BlockGroup(bg_start)
+
+    if (rtype == NORMAL_KIND):
+        bg.add_normal(off, l, a, b, c)
+    elif (rtype == FREE_KIND):
+        bg.add_free(off, l)
+    elif (rtype == SHARED_KIND):
+        bg.add_shared(off, l, a)
+    elif (rtype == METADATA_KIND):
+        bg.add_metadata(off, l, a, b)
+    elif (rtype == BG_DONE_KIND):
         bg.finish()
+        return bg
+    return None
 
-def process_frag_lines(lines):
+def process_frag_records(records):
     bgs = {}
-    for line in lines:
-        process_frag_line(bgs, line)
+    for record in records:
+        process_frag_record(bgs, *record)
     return bgs
 
-def process_frag(frag_file):
-    with open(frag_file, 'r') as f:
-        bgs = process_frag_lines(f.readlines())
-        owners = {}
-        for bg in bgs.values():
-            #print(bg)
-            #print(bg.contig_hist)
-            #print(bg.contig_cdf)
-            #print(bg.contig_pdf)
-            print(bg)
-            print(bg.free_hist)
+def process_frag_lines(lines):
+    return process_frag_records(map(parse_frag_line, lines))
+
+# Yield each block group as soon as its BG-DONE record is parsed and forget
+# its extents once the caller is done with it, so peak memory follows the
+# largest block group rather than the size of the whole dump.
+def stream_frag_records(records, bgs=None, final=True):
+    if bgs is None:
+        bgs = {}
+    for record in records:
+        bg = process_frag_record(bgs, *record)
+        if bg is None:
             continue
-            for extent in bg.extents:
-                iden = extent.owner()
-                if iden not in owners:
-                    owners[iden] = ExtentOwner(iden)
-                owners[iden].add_extent(extent)
-        owners = sorted(owners.items(), key=lambda kv: kv[1].num_extents())
-        #for owner in owners[-50:]:
-            #print(owner[1])
+        del bgs[bg.start]
+        yield bg
+        bg.drop_extents()
+    if not final:
+        return
+    for bg_start in bgs:
+        print(f"block group {bg_start} has no {BG_DONE}", file=sys.stderr)
+
+def stream_frag_lines(lines):
+    return stream_frag_records(map(parse_frag_line, lines))
+
+# Records read live from a pipe, e.g. btrd bg-frag.btrd | process-bg-frag.py -.
+# Lines that are not records, like the bpftrace "Attaching N probes..."
+# banner, are skipped. A record may start with a numeric sort key, like the
+# time stamp that sort-stream.sh sorts on. Yields (sort key, record), where
+# the sort key is None if the line had none.
+def parse_pipe_lines(lines):
+    for line in lines:
+        cols = line.split()
+        key = None
+        if len(cols) > 1 and cols[0] not in RECORD_TYPES and cols[1] in RECORD_TYPES:
+            key = cols[0]
+            cols = cols[1:]
+        rtype = RECORD_TYPES.get(cols[0]) if cols else None
+        if rtype is None or len(cols) != RECORD_WIDTHS[rtype] + 1:
+            continue
+        try:
+            if key is not None:
+                key = float(key)
+            nums = list(map(int, cols[1:]))
+        except ValueError:
+            continue
+        a = b = c = 0
+        if rtype == SHARED_KIND:
+            a = nums[3]
+        elif rtype == NORMAL_KIND:
+            a, b, c = nums[3:]
+        elif rtype == METADATA_KIND:
+            a, b = nums[3:]
+        yield key, (rtype, nums[0], nums[1], nums[2], a, b, c)
+
+# Put records back in order through a heap of at most window records, in
+# place of a full sort of the dump. Records with a sort key come out by key.
+# The others come out by block group and offset, with each BG-DONE after the
+# rest of its block group, which is already the order bg-frag.btrd prints
+# them in. Ties keep the input order. Records more than window places out of
+# order stay out of order.
+def reorder_records(keyed_records, window):
+    heap = []
+    for seq, (key, record) in enumerate(keyed_records):
+        if key is None:
+            rtype, bg_start, off = record[:3]
+            key = (bg_start, rtype == BG_DONE_KIND, off)
+        else:
+            key = (key,)
+        if len(heap) < window:
+            heapq.heappush(heap, (key, seq, record))
+        else:
+            yield heapq.heappushpop(heap, (key, seq, record))[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+def stream_pipe_lines(lines, window):
+    return stream_frag_records(reorder_records(parse_pipe_lines(lines), window))
+
+# Sort the whole dump by block group and offset with extsort first, in
+# bounded memory, and analyze the records as the merge yields them.
+def stream_sorted_lines(lines, args):
+    import extsort
+    sorted_lines = extsort.external_sort(lines, memory=args.sort_memory << 20, jobs=args.jobs)
+    return stream_frag_records(record for _, record in parse_pipe_lines(sorted_lines))
+
+# Split a dump into about nr_shards byte ranges that each end right after a
+# BG-DONE record. bg-frag.btrd emits every block group contiguously, so no
+# block group straddles two shards; process_shards() checks that it did not.
+def split_frag_file(frag_file, nr_shards):
+    size = os.path.getsize(frag_file)
+    bounds = [0]
+    with open(frag_file, 'rb') as f:
+        for i in range(1, nr_shards):
+            target = max(size * i // nr_shards, bounds[-1])
+            f.seek(target)
+            if target > 0:
+                f.readline()
+            for line in f:
+                if line.startswith(BG_DONE.encode()):
+                    break
+            pos = f.tell()
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    if bounds[-1] < size:
+        bounds.append(size)
+    return [(frag_file, start, end) for start, end in zip(bounds, bounds[1:])]
+
+def read_shard_lines(f, start, end):
+    f.seek(start)
+    pos = start
+    while pos < end:
+        line = f.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line.decode()
+
+# Returns the finished block groups of a shard, their analysis and the
+# starts of the block groups it left without a BG-DONE.
+def process_frag_shard(args, shard):
+    frag_file, start, end = shard
+    analysis = Analysis(args)
+    bgs = []
+    open_bgs = {}
+    with open(frag_file, 'rb') as f:
+        if args.parser == 'bulk':
+            shard_bgs = stream_frag_bulk(f, start, end, open_bgs)
+        else:
+            records = map(parse_frag_line, read_shard_lines(f, start, end))
+            shard_bgs = stream_frag_records(records, open_bgs, final=False)
+        for bg in shard_bgs:
+            analysis.add_bg(bg)
+            bgs.append(bg)
+    return bgs, analysis, list(open_bgs)
+
+# The record table of a dump is cached next to it in <dump>.cache, one raw
+# file per column, and keyed by the size and mtime of the dump. Later runs
+# memory-map the columns instead of parsing the text again.
+CACHE_VERSION = 2
+
+def cache_dir(frag_file):
+    return f"{frag_file}.cache"
+
+def cache_key(frag_file):
+    st = os.stat(frag_file)
+    return f"{CACHE_VERSION} {st.st_size} {st.st_mtime_ns}"
+
+def load_cache(frag_file):
+    path = cache_dir(frag_file)
+    try:
+        with open(f"{path}/key", 'r') as f:
+            if f.read() != cache_key(frag_file):
+                return None
+    except FileNotFoundError:
+        return None
+    recs = {}
+    for name in RECORD_COLUMNS:
+        col_file = f"{path}/{name}.bin"
+        if os.path.getsize(col_file) == 0:
+            recs[name] = np.zeros(0, dtype=RECORD_DTYPES[name])
+        else:
+            recs[name] = np.memmap(col_file, dtype=RECORD_DTYPES[name], mode='r')
+    return recs
+
+def write_cache(frag_file, chunks):
+    path = cache_dir(frag_file)
+    key = cache_key(frag_file)
+    tmp = f"{path}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.mkdir(tmp)
+    col_files = {name: open(f"{tmp}/{name}.bin", 'wb') for name in RECORD_COLUMNS}
+    for chunk in chunks:
+        for name, f in col_files.items():
+            chunk[name].astype(RECORD_DTYPES[name]).tofile(f)
+    for f in col_files.values():
+        f.close()
+    # the key goes in last and marks the columns complete
+    with open(f"{tmp}/key", 'w') as f:
+        f.write(key)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+
+def load_or_build_cache(frag_file):
+    recs = load_cache(frag_file)
+    if recs is None:
+        with open(frag_file, 'rb') as f:
+            write_cache(frag_file, tokenize_frag_bulk(f))
+        recs = load_cache(frag_file)
+    return recs
+
+# Indices of the BG-DONE records in [lo, hi) of a record table.
+def record_dones(recs, lo, hi):
+    dones = [i + np.flatnonzero(recs['type'][i:min(i + RECORD_CHUNK, hi)] == BG_DONE_KIND)
+             for i in range(lo, hi, RECORD_CHUNK)]
+    return np.concatenate(dones) if dones else np.zeros(0, dtype=np.int64)
+
+# Yield the finished block groups of records [lo, hi) of a record table,
+# building each one with add_records() from only its own slice. Once block
+# groups interleave, the rest is replayed record by record instead, leaving
+# the block groups it did not finish in bgs if given.
+def frag_records_bgs(recs, lo, hi, drop=True, bgs=None):
+    seg_start = lo
+    for done in record_dones(recs, lo, hi):
+        start = int(recs['bg'][done])
+        seg = slice(seg_start, done)
+        if not np.all(recs['bg'][seg] == start):
+            break
+        bg = BlockGroup(start)
+        bg.add_records(np.asarray(recs['type'][seg]),
+                       np.asarray(recs['off'][seg], dtype=np.int64),
+                       np.asarray(recs['len'][seg], dtype=np.int64),
+                       *(np.asarray(recs[name][seg]) for name in ['a', 'b', 'c']))
+        bg.finish()
+        yield bg
+        if drop:
+            bg.drop_extents()
+        seg_start = done + 1
+    if seg_start < hi:
+        yield from replay_records(recs, seg_start, hi, drop, bgs)
+
+def iter_records(recs, lo, hi):
+    for i in range(lo, hi, RECORD_CHUNK):
+        chunk = slice(i, min(i + RECORD_CHUNK, hi))
+        yield from zip(*(recs[name][chunk].tolist() for name in RECORD_COLUMNS))
+
+def replay_records(recs, lo, hi, drop, bgs=None):
+    if drop:
+        yield from stream_frag_records(iter_records(recs, lo, hi), bgs, final=bgs is None)
+    else:
+        yield from process_frag_records(iter_records(recs, lo, hi)).values()
+
+# Split a record table into about nr_shards ranges that end at a BG-DONE.
+def split_records(recs, nr_shards):
+    n = len(recs['type'])
+    dones = record_dones(recs, 0, n) + 1
+    bounds = [0]
+    for i in range(1, nr_shards):
+        j = np.searchsorted(dones, n * i // nr_shards)
+        if j < len(dones) and dones[j] > bounds[-1]:
+            bounds.append(int(dones[j]))
+    if bounds[-1] < n:
+        bounds.append(n)
+    return list(zip(bounds, bounds[1:]))
+
+def process_cache_shard(args, shard):
+    frag_file, lo, hi = shard
+    recs = load_cache(frag_file)
+    analysis = Analysis(args)
+    bgs = []
+    open_bgs = {}
+    for bg in frag_records_bgs(recs, lo, hi, bgs=open_bgs):
+        analysis.add_bg(bg)
+        bgs.append(bg)
+    return bgs, analysis, list(open_bgs)
+
+SHARDS_PER_JOB = 4
+
+# Parse the shards of a dump, or of its record table, in args.jobs
+# processes. A block group that more than one shard saw was cut by a shard
+# boundary, as in a dump whose block groups interleave, and every shard
+# that saw it got it wrong, so then None is returned for the caller to
+# parse the dump in one process instead.
+def process_shards(args, frag_file, recs):
+    if recs is not None:
+        shards = [(frag_file, lo, hi) for lo, hi in split_records(recs, args.jobs * SHARDS_PER_JOB)]
+        process_shard = process_cache_shard
+    else:
+        shards = split_frag_file(frag_file, args.jobs * SHARDS_PER_JOB)
+        process_shard = process_frag_shard
+    with multiprocessing.Pool(args.jobs) as pool:
+        results = pool.map(partial(process_shard, args), shards)
+    seen = collections.Counter()
+    for bgs, _, open_starts in results:
+        seen.update({bg.start for bg in bgs} | set(open_starts))
+    cut = [bg_start for bg_start, n in seen.items() if n > 1]
+    if cut:
+        print(f"block group {cut[0]} is split over shards, parsing in one process", file=sys.stderr)
+        return None
+    for _, _, open_starts in results:
+        for bg_start in open_starts:
+            print(f"block group {bg_start} has no {BG_DONE}", file=sys.stderr)
+    return [(bgs, analysis) for bgs, analysis, _ in results]
+
+# Fingerprint the record stream of each block group of a dump: the bytes
+# from the end of the previous BG-DONE line to the end of its own. Returns
+# {bg_start: (digest, start, end)} with the byte range of each block group.
+def fingerprint_frag_file(frag_file):
+    fps = {}
+    if os.path.getsize(frag_file) == 0:
+        return fps
+    tag = f"{BG_DONE} ".encode()
+    with open(frag_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = pos = 0
+        while True:
+            i = mm.find(tag, pos)
+            if i < 0:
+                break
+            pos = i + 1
+            if i > 0 and mm[i - 1] != ord('\n'):
+                continue
+            end = mm.find(b'\n', i)
+            end = len(mm) if end < 0 else end + 1
+            bg_start = int(mm[i:end].split()[1])
+            fps[bg_start] = (hashlib.blake2b(mm[start:end], digest_size=16).digest(), start, end)
+            start = pos = end
+    return fps
+
+# Finish just the block groups at the given byte ranges of a dump.
+def process_frag_ranges(args, frag_file, ranges):
+    shards = [(frag_file, start, end) for start, end in ranges]
+    if args.jobs > 1:
+        with multiprocessing.Pool(args.jobs) as pool:
+            results = pool.map(partial(process_frag_shard, args), shards)
+    else:
+        results = [process_frag_shard(args, shard) for shard in shards]
+    return {bg.start: bg for bgs, _, _ in results for bg in bgs}
+
+DIFF_FIELDS = ['free_pct', 'frag_pct', 'max_free', 'num_contigs']
+
+def diff_str(status, start, old, new):
+    vals = [getattr(new, field) if new else 0 for field in DIFF_FIELDS]
+    deltas = [val - (getattr(old, field) if old else 0) for field, val in zip(DIFF_FIELDS, vals)]
+    return f"{status} {start} {' '.join(str(v) for v in vals)} {' '.join(f'{d:+}' for d in deltas)}"
+
+# Compare two dumps of the same filesystem. Block groups whose record
+# streams fingerprint the same have the same stats, so only the changed
+# ones are parsed and finished, in both dumps.
+def diff_frag(args):
+    old_fps = fingerprint_frag_file(args.diff)
+    new_fps = fingerprint_frag_file(args.frag_file)
+    changed = [start for start, fp in new_fps.items()
+               if start in old_fps and old_fps[start][0] != fp[0]]
+    added = [start for start in new_fps if start not in old_fps]
+    removed = [start for start in old_fps if start not in new_fps]
+    old_bgs = process_frag_ranges(args, args.diff, [old_fps[start][1:] for start in changed + removed])
+    new_bgs = process_frag_ranges(args, args.frag_file, [new_fps[start][1:] for start in changed + added])
+    for start in sorted(changed + added + removed):
+        old = old_bgs.get(start)
+        new = new_bgs.get(start)
+        status = 'changed' if old and new else ('added' if new else 'removed')
+        print(diff_str(status, start, old, new))
+    unchanged = len(new_fps) - len(changed) - len(added)
+    print(f"unchanged {unchanged} changed {len(changed)} added {len(added)} removed {len(removed)}")
+
+BG_FIELDS = ['start', 'len', 'free', 'num_free', 'avg_free', 'used', 'num_extents', 'avg_extent',
+             'num_contigs', 'avg_contig', 'used_pct', 'free_pct', 'frag_pct']
+HIST_FIELDS = ['free_hist', 'contig_hist']
+# Fixed histogram columns for the table formats: 4K up to 16G, as a block
+# group is at most 10G. Anything larger is counted in the last one.
+REPORT_HIST_BUCKETS = 23
+REPORT_BATCH = 4096
+
+def hist_row(hist):
+    row = [0] * REPORT_HIST_BUCKETS
+    for step, n in hist.items():
+        row[min(step.bit_length() - HIST_MIN.bit_length(), REPORT_HIST_BUCKETS - 1)] += n
+    return row
+
+def table_columns():
+    return BG_FIELDS + [f'{name}_{HIST_MIN << i}' for name in HIST_FIELDS for i in range(REPORT_HIST_BUCKETS)]
+
+def table_row(bg):
+    return bg.fields() + hist_row(bg.free_hist) + hist_row(bg.contig_hist)
+
+# Report writers get each finished block group through add() and write to
+# path, or stdout if None. The text ones collect REPORT_BATCH block groups
+# per write.
+class TextReport:
+    def __init__(self, path):
+        self.out = open(path, 'w') if path else sys.stdout
+        self.batch = []
+        self.start()
+
+    def start(self):
+        pass
+
+    def format(self, bg):
+        return f'{bg}\n{bg.free_hist}\n'
+
+    def add(self, bg):
+        self.batch.append(self.format(bg))
+        if len(self.batch) >= REPORT_BATCH:
+            self.flush()
+
+    def flush(self):
+        self.out.write(''.join(self.batch))
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        if self.out is sys.stdout:
+            self.out.flush()
+        else:
+            self.out.close()
+
+# One JSON object per block group, with the histograms as
+# {"bucket": count} objects.
+class JsonlReport(TextReport):
+    def format(self, bg):
+        row = dict(zip(BG_FIELDS, bg.fields()))
+        for name in HIST_FIELDS:
+            row[name] = getattr(bg, name)
+        return json.dumps(row) + '\n'
+
+class CsvReport(TextReport):
+    def start(self):
+        self.batch.append(','.join(table_columns()) + '\n')
+
+    def format(self, bg):
+        return ','.join(str(val) for val in table_row(bg)) + '\n'
+
+# One <field>.npy per column of BG_FIELDS and one n x REPORT_HIST_BUCKETS
+# <hist>.npy per histogram, all written into the directory path at close().
+class NpyReport:
+    def __init__(self, path):
+        self.path = path
+        self.rows = array('q')
+
+    def add(self, bg):
+        self.rows.extend(table_row(bg))
+
+    def close(self):
+        os.makedirs(self.path, exist_ok=True)
+        table = np.frombuffer(self.rows, dtype=np.int64).reshape(-1, len(table_columns()))
+        for i, name in enumerate(BG_FIELDS):
+            np.save(os.path.join(self.path, f'{name}.npy'), table[:, i])
+        for i, name in enumerate(HIST_FIELDS):
+            lo = len(BG_FIELDS) + i * REPORT_HIST_BUCKETS
+            np.save(os.path.join(self.path, f'{name}.npy'), table[:, lo:lo + REPORT_HIST_BUCKETS])
+
+REPORTS = {'text': TextReport, 'jsonl': JsonlReport, 'csv': CsvReport, 'npy': NpyReport}
+
+def count(it):
+    return sum(1 for _ in it)
+
+# Time the line and bulk parsers on a dump, tokenizing only and then with
+# every block group finished, and optionally profile each.
+def bench_parse(args):
+    frag_file = args.frag_file
+    with open(frag_file, 'rb') as f:
+        nr_lines = sum(block.count(b'\n') for block in read_blocks(f))
+    runs = [
+        ('line-tokenize', lambda: count(tokenize_frag_lines(open(frag_file, 'r')))),
+        ('bulk-tokenize', lambda: count(tokenize_frag_bulk(open(frag_file, 'rb')))),
+        ('line-parse', lambda: count(stream_frag_lines(open(frag_file, 'r')))),
+        ('bulk-parse', lambda: count(stream_frag_bulk(open(frag_file, 'rb')))),
+    ]
+    for name, run in runs:
+        t = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - t
+        print(f"{name} {nr_lines} lines {elapsed:.2f}s {int(nr_lines / elapsed)} lines/s")
+        if args.profile:
+            prof = cProfile.Profile()
+            prof.runcall(run)
+            pstats.Stats(prof, stream=sys.stderr).sort_stats('cumulative').print_stats(12)
+
+def process_frag(args):
+    if args.bench_parse:
+        bench_parse(args)
+        return
+    if args.diff:
+        diff_frag(args)
+        return
+    frag_file = args.frag_file
+    analysis = Analysis(args)
+    report = REPORTS[args.format](args.output)
+    recs = load_or_build_cache(frag_file) if args.cache else None
+    if args.sort:
+        f = sys.stdin if frag_file == '-' else open(frag_file, 'r')
+        for bg in stream_sorted_lines(f, args):
+            report.add(bg)
+            analysis.add_bg(bg)
+    elif args.jobs > 1 and (results := process_shards(args, frag_file, recs)) is not None:
+        for bgs, shard_analysis in results:
+            for bg in bgs:
+                report.add(bg)
+            analysis.merge(shard_analysis)
+    elif args.stream or args.parser == 'bulk' or args.jobs > 1:
+        if frag_file == '-':
+            bgs = stream_pipe_lines(sys.stdin, args.reorder)
+        elif recs is not None:
+            bgs = frag_records_bgs(recs, 0, len(recs['type']))
+        elif args.parser == 'bulk':
+            bgs = stream_frag_bulk(open(frag_file, 'rb'))
+        else:
+            f = open(frag_file, 'r')
+            bgs = stream_frag_lines(f)
+        for bg in bgs:
+            report.add(bg)
+            analysis.add_bg(bg)
+    else:
+        if recs is not None:
+            bgs = {bg.start: bg for bg in frag_records_bgs(recs, 0, len(recs['type']), drop=False)}
+        else:
+            with open(frag_file, 'r') as f:
+                bgs = process_frag_lines(f)
+        for bg in bgs.values():
+            report.add(bg)
+            analysis.add_bg(bg)
+    report.close()
+    report_analysis(analysis, args)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("USAGE: process-bg-frag.py <bg-frag.out>")
-        exit(1)
-    process_frag(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Analyze the output of bg-frag.btrd.")
+    parser.add_argument('--stream', action='store_true',
+                        help='Report each block group at its BG-DONE and drop its extents')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Parse shards of the dump in N processes (implies --stream)')
+    parser.add_argument('--summary', action='store_true',
+                        help='Also report the filesystem-wide totals')
+    parser.add_argument('--cache', action='store_true',
+                        help='Load the dump from its binary <dump>.cache, writing it first if missing or stale')
+    parser.add_argument('--owners', type=int, default=0, metavar='K',
+                        help='Also report the K owners (tree:ino or shared ref) with the most extents')
+    parser.add_argument('--defrag', type=int, default=0, metavar='K',
+                        help='Also report the K files (tree:ino) that would gain the most from a defrag: '
+                             'tree:ino score extents MiB extents/MiB block_groups mean_contig gain_bytes')
+    parser.add_argument('--parser', choices=['line', 'bulk'], default='line',
+                        help='Parse line by line, or in large vectorized blocks (implies --stream)')
+    parser.add_argument('--bench-parse', action='store_true',
+                        help='Report the lines per second of the line and bulk parsers instead')
+    parser.add_argument('--profile', action='store_true',
+                        help='With --bench-parse, print a cProfile of each parser to stderr')
+    parser.add_argument('--diff', metavar='OLD',
+                        help='Report the per block group changes from the older dump OLD instead')
+    parser.add_argument('--alloc', metavar='SIZES',
+                        help='Replay the allocation sizes in file SIZES against the free space and report each failure')
+    parser.add_argument('--alloc-policy', choices=ALLOC_POLICIES, default='first-fit',
+                        help='With --alloc, search from the first block group, or from the last allocation')
+    parser.add_argument('--alloc-window', type=int, default=0, metavar='N',
+                        help='With --alloc, also report the block groups searched per N allocations')
+    parser.add_argument('--sort', action='store_true',
+                        help='Sort the dump by block group and offset first, with -j processes (implies --stream)')
+    parser.add_argument('--sort-memory', type=int, default=1024, metavar='MB',
+                        help='With --sort, about how much memory the sort may take')
+    parser.add_argument('--reloc', type=parse_size, default=0, metavar='BYTES',
+                        help='Plan which block groups to relocate to get BYTES (K/M/G/T) of unallocated space back, '
+                             'and compare with the kernel threshold policy')
+    parser.add_argument('--reloc-extent-cost', type=parse_size, default=16 << 10, metavar='BYTES',
+                        help='With --reloc, count each relocated extent as this many bytes moved')
+    parser.add_argument('--reloc-thresh', type=int, default=75, metavar='PCT',
+                        help='With --reloc, the bg_reclaim_threshold to compare with')
+    parser.add_argument('--size-classes', action='store_true',
+                        help='Report how the extents of each block group mix by size class')
+    parser.add_argument('--class-bounds', default=SIZE_CLASS_BOUNDS, metavar='BOUNDS',
+                        help=f'Comma separated upper bounds of the size classes (default {SIZE_CLASS_BOUNDS})')
+    parser.add_argument('--metadata', action='store_true',
+                        help='Report the tree blocks of the metadata block groups per block group and per tree')
+    parser.add_argument('--raster', metavar='PATH',
+                        help='Draw each block group as <start>.png in directory PATH, or all of them into one atlas if PATH ends in .png (needs matplotlib)')
+    parser.add_argument('--raster-size', type=int, default=64, metavar='N',
+                        help='With --raster, draw each block group as N x N pixels')
+    parser.add_argument('--reorder', type=int, default=4096, metavar='N',
+                        help='When reading stdin, reorder the records within a window of N')
+    parser.add_argument('--format', choices=list(REPORTS), default='text',
+                        help='Write the block groups as text, JSON lines, CSV or a directory of .npy columns')
+    parser.add_argument('-o', '--output', metavar='PATH',
+                        help='Write the block groups to PATH instead of stdout (a directory for npy)')
+    parser.add_argument('frag_file', metavar='bg-frag.out',
+                        help="The dump, or - to read it as it is printed from stdin (implies --stream)")
+    args = parser.parse_args()
+    args.class_bounds = sorted(parse_size(bound) for bound in args.class_bounds.split(','))
+    if args.format == 'npy' and not args.output:
+        parser.error("--format npy needs -o DIR")
+    if args.sort:
+        if args.cache or args.diff or args.bench_parse or args.parser == 'bulk':
+            parser.error("--sort only works with the line parser and without --cache, --diff and --bench-parse")
+    elif args.frag_file == '-':
+        if args.cache or args.jobs > 1 or args.diff or args.bench_parse or args.parser == 'bulk':
+            parser.error("reading stdin only works with the line parser and without --cache, --jobs, --diff and --bench-parse")
+        args.stream = True
+    process_frag(args)